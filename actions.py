@@ -0,0 +1,278 @@
+from typing import List, Optional
+from collections import deque
+import threading
+import logging
+import time
+
+from telegram import Bot, ChatPermissions
+from telegram.error import BadRequest, RetryAfter, TelegramError
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket():
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self) -> float:
+        """Takes a token if there is one and returns 0, otherwise returns how long to wait for it."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0.0
+            return (1 - self.tokens) / self.rate
+
+    def full(self) -> bool:
+        with self.lock:
+            return self.tokens + (time.monotonic() - self.updated) * self.rate >= self.burst
+
+    def wait(self):
+        while True:
+            delay = self.take()
+            if not delay:
+                return
+            time.sleep(delay)
+
+
+class ChatActions():
+    """Moderation actions waiting to be sent for one chat, merged as they arrive."""
+
+    def __init__(self):
+        self.warnings = dict()
+        self.deletions = []
+        self.mutes = dict()
+        self.bans = dict()
+
+    def __bool__(self):
+        return bool(self.warnings or self.deletions or self.mutes or self.bans)
+
+
+class ActionScheduler():
+    """Sends moderation calls from a worker pool without running into Telegram flood limits.
+
+    Messages to a chat go through a per-chat token bucket, every call goes through a
+    global one. Actions queued for a chat are merged: one warning per user, a mute is
+    dropped when the user is also being banned, deletions are sent together. A chat
+    answered with retry_after is not called again until it has passed. Calls for a
+    chat are made by one worker at a time, in the order warnings, deletions, mutes, bans.
+    """
+
+    # Seconds between sweeps of the per-chat buckets that have refilled
+    sweep_interval = 60
+
+    def __init__(self, bot: Bot, workers: int = 8, chat_rate: float = 17 / 60, chat_burst: float = 3, global_rate: float = 25, global_burst: float = 5):
+        self.bot = bot
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.buckets = dict()
+        self.swept = time.monotonic()
+        self.pending = dict()
+        # Chats with pending actions that no worker is sending right now
+        self.ready = deque()
+        # Chats a worker is sending actions for, new actions wait until it is done
+        self.sending = set()
+        self.paused = dict()
+        self.changed = threading.Condition()
+        self.running = True
+        self.threads = [threading.Thread(target=self.run, name="ActionScheduler-%d" % i, daemon=True) for i in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def chat(self, chat_id: int) -> ChatActions:
+        actions = self.pending.get(chat_id)
+        if actions is None:
+            actions = self.pending[chat_id] = ChatActions()
+            if chat_id not in self.sending:
+                self.ready.append(chat_id)
+                self.changed.notify()
+        return actions
+
+    def warn(self, chat_id: int, user_id: int, message_id: int, text: str):
+        with self.changed:
+            actions = self.chat(chat_id)
+            if user_id not in actions.warnings:
+                actions.warnings[user_id] = (message_id, text)
+
+    def delete(self, chat_id: int, message_id: int):
+        with self.changed:
+            self.chat(chat_id).deletions.append(message_id)
+
+    def mute(self, chat_id: int, user_id: int, until: int):
+        with self.changed:
+            actions = self.chat(chat_id)
+            if user_id not in actions.bans:
+                actions.mutes[user_id] = max(until, actions.mutes.get(user_id, 0))
+
+    def ban(self, chat_id: int, user_id: int, until: int):
+        with self.changed:
+            actions = self.chat(chat_id)
+            actions.mutes.pop(user_id, None)
+            actions.bans[user_id] = max(until, actions.bans.get(user_id, 0))
+
+    def queue_depth(self) -> int:
+        with self.changed:
+            return len(self.pending)
+
+    def next_chat(self) -> Optional[int]:
+        with self.changed:
+            while self.running:
+                now = time.monotonic()
+                for _ in range(len(self.ready)):
+                    chat_id = self.ready.popleft()
+                    if self.paused.get(chat_id, 0) <= now:
+                        self.paused.pop(chat_id, None)
+                        return chat_id
+                    self.ready.append(chat_id)
+                wait = min([self.paused[chat_id] for chat_id in self.ready], default=now + 1) - now
+                self.changed.wait(max(wait, 0.01))
+            return None
+
+    def run(self):
+        while True:
+            chat_id = self.next_chat()
+            if chat_id is None:
+                break
+            # New actions for this chat are collected in a fresh record while these are sent
+            with self.changed:
+                actions = self.pending.pop(chat_id)
+                self.sending.add(chat_id)
+            try:
+                delay = self.send(chat_id, actions)
+            except RetryAfter as e:
+                logger.warning("Flood limit in chat %d, retrying after %s s", chat_id, e.retry_after)
+                delay = e.retry_after
+            except Exception:
+                logger.exception("Failed to apply actions in chat %d", chat_id)
+                actions, delay = ChatActions(), 0.0
+            with self.changed:
+                self.sending.discard(chat_id)
+                # Warnings over the chat's message rate wait for it without holding up this worker
+                if actions:
+                    self.requeue(chat_id, actions)
+                    self.paused[chat_id] = time.monotonic() + delay
+                elif chat_id in self.pending:
+                    self.ready.append(chat_id)
+                    self.changed.notify()
+                self.sweep()
+
+    def sweep(self):
+        """Forgets the buckets of chats that are idle long enough for them to be full again."""
+        now = time.monotonic()
+        if now - self.swept < self.sweep_interval:
+            return
+        self.swept = now
+        for chat_id in [chat_id for chat_id, bucket in self.buckets.items() if chat_id not in self.pending and chat_id not in self.sending and bucket.full()]:
+            del self.buckets[chat_id]
+
+    def requeue(self, chat_id: int, actions: ChatActions):
+        """Puts back what is left of the actions a worker sent, merged with actions that arrived meanwhile."""
+        newer = self.pending.get(chat_id)
+        self.pending[chat_id] = actions
+        self.ready.append(chat_id)
+        if newer is not None:
+            for user_id, warning in newer.warnings.items():
+                actions.warnings.setdefault(user_id, warning)
+            actions.deletions += newer.deletions
+            for user_id, until in newer.mutes.items():
+                if user_id not in actions.bans:
+                    actions.mutes[user_id] = max(until, actions.mutes.get(user_id, 0))
+            for user_id, until in newer.bans.items():
+                actions.mutes.pop(user_id, None)
+                actions.bans[user_id] = max(until, actions.bans.get(user_id, 0))
+        self.changed.notify()
+
+    def call(self, action: str, function, *args, **kwargs):
+        self.global_bucket.wait()
+        with metrics.action_seconds.time(action=action):
+            return function(*args, **kwargs)
+
+    def attempt(self, chat_id: int, action: str, function, *args, **kwargs) -> bool:
+        """Makes a call, an error other than a flood limit only drops this action."""
+        try:
+            self.call(action, function, *args, **kwargs)
+            return True
+        except RetryAfter:
+            raise
+        except TelegramError as e:
+            logger.warning("Failed to %s in chat %d: %s", action, chat_id, e)
+            return False
+
+    def send(self, chat_id: int, actions: ChatActions) -> float:
+        """Sends the actions and removes each one once it is done, so after RetryAfter only the rest is requeued.
+
+        Returns 0, or the seconds until the chat's message rate allows the warnings left in actions.
+        """
+        with self.changed:
+            bucket = self.buckets.setdefault(chat_id, TokenBucket(self.chat_rate, self.chat_burst))
+        delay = 0.0
+        while actions.warnings:
+            delay = bucket.take()
+            if delay:
+                break
+            user_id, (message_id, text) = next(iter(actions.warnings.items()))
+            self.attempt(chat_id, "warn", self.bot.send_message, chat_id, text, reply_to_message_id=message_id, allow_sending_without_reply=True)
+            del actions.warnings[user_id]
+        if actions.deletions:
+            self.delete_messages(chat_id, actions.deletions)
+        while actions.mutes:
+            user_id, until = next(iter(actions.mutes.items()))
+            if self.attempt(chat_id, "mute", self.bot.restrict_chat_member, chat_id, user_id, ChatPermissions(can_send_messages=False), until_date=until):
+                metrics.messages.inc(outcome="muted")
+            del actions.mutes[user_id]
+        while actions.bans:
+            user_id, until = next(iter(actions.bans.items()))
+            if self.attempt(chat_id, "ban", self.bot.ban_chat_member, chat_id, user_id, until_date=until):
+                metrics.messages.inc(outcome="banned")
+            del actions.bans[user_id]
+        return delay
+
+    def delete_messages(self, chat_id: int, message_ids: List[int]):
+        """Deletes the messages, removing ids from message_ids as they are done."""
+        if len(message_ids) > 1:
+            # deleteMessages takes up to 100 ids, the library has no wrapper for it
+            try:
+                while message_ids:
+                    chunk = message_ids[:100]
+                    self.call("delete", self.bot._post, "deleteMessages", {"chat_id": chat_id, "message_ids": chunk})
+                    metrics.messages.inc(len(chunk), outcome="deleted")
+                    del message_ids[:len(chunk)]
+                return
+            except RetryAfter:
+                raise
+            except TelegramError:
+                logger.debug("deleteMessages failed, deleting one by one")
+        while message_ids:
+            try:
+                self.call("delete", self.bot.delete_message, chat_id, message_ids[0])
+                metrics.messages.inc(outcome="deleted")
+            except BadRequest as e:
+                # Already deleted by an admin or by an earlier attempt
+                if "not found" not in e.message.lower():
+                    logger.warning("Failed to delete message %d in chat %d: %s", message_ids[0], chat_id, e)
+            except RetryAfter:
+                raise
+            except TelegramError as e:
+                logger.warning("Failed to delete message %d in chat %d: %s", message_ids[0], chat_id, e)
+            message_ids.pop(0)
+
+    def stop(self):
+        """Sends what is pending and stops the workers."""
+        while True:
+            with self.changed:
+                if not self.pending and not self.sending:
+                    self.running = False
+                    self.changed.notify_all()
+                    break
+            time.sleep(0.1)
+        for thread in self.threads:
+            thread.join()
@@ -0,0 +1,78 @@
+from typing import Callable, List, Optional, Union
+from concurrent.futures import Future
+from queue import Queue, Empty
+import threading
+import time
+
+
+class BatchScorer():
+    """Collects pending sentences from all chats and scores them in one forward pass.
+
+    A batch is flushed when it reaches max_batch_size or when the oldest sentence
+    has waited max_wait seconds, whichever comes first.
+    """
+
+    def __init__(self, score_batch: Callable[[List[str]], Union[List[float], Future]], max_batch_size: int = 32, max_wait: float = 0.005):
+        self.score_batch = score_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue = Queue()
+        self.thread = threading.Thread(target=self.run, name="BatchScorer", daemon=True)
+        self.thread.start()
+
+    def submit(self, sentence: str) -> Future:
+        future = Future()
+        self.queue.put((sentence, future))
+        return future
+
+    def score(self, sentence: str, timeout: Optional[float] = None) -> float:
+        return self.submit(sentence).result(timeout)
+
+    def stop(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def run(self):
+        running = True
+        while running:
+            item = self.queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout=remaining)
+                except Empty:
+                    break
+                if item is None:
+                    running = False
+                    break
+                batch.append(item)
+            self.process(batch)
+
+    def process(self, batch):
+        batch = [(sentence, future) for sentence, future in batch if future.set_running_or_notify_cancel()]
+        if not batch:
+            return
+        try:
+            scores = self.score_batch([sentence for sentence, _ in batch])
+        except Exception as e:
+            self.resolve(batch, None, e)
+            return
+        # score_batch may hand the batch off to another process and return a Future of the scores
+        if isinstance(scores, Future):
+            scores.add_done_callback(lambda f: self.resolve(batch, None, f.exception()) if f.exception() else self.resolve(batch, f.result()))
+        else:
+            self.resolve(batch, scores)
+
+    def resolve(self, batch, scores, exception=None):
+        if exception is not None:
+            for _, future in batch:
+                future.set_exception(exception)
+            return
+        for (_, future), score in zip(batch, scores):
+            future.set_result(score)
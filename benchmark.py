@@ -0,0 +1,206 @@
+import random
+import time
+import argparse
+import statistics
+import subprocess
+import platform
+import json
+import sys
+import os
+import re
+
+import numpy as np
+import torch
+
+import checker
+from normalizer import normalize, normalize_batch
+
+words = ["привет", "как", "дела", "ок", "спасибо", "лол", "да", "нет", "ну", "это", "что", "кто", "где",
+         "сегодня", "завтра", "вообще", "короче", "понятно", "нормально", "блин", "почему", "зачем",
+         "сообщение", "админ", "чат", "бот", "ребята", "кстати", "смотри", "думаю", "просто", "очень"]
+
+
+def synthetic_messages(count: int, seed: int = 42):
+    # Most chat messages are a few words long, with a long tail of paragraphs
+    rng = random.Random(seed)
+    messages = []
+    for _ in range(count):
+        length = max(1, min(100, int(rng.lognormvariate(1.3, 0.9))))
+        message = " ".join(rng.choice(words) for _ in range(length))
+        if rng.random() < 0.3:
+            message += rng.choice(["!", ")))", "?", "...", " https://t.me/chat", ", [id1|Вася]", " &quot;ок&quot;"])
+        messages.append(message)
+    return messages
+
+
+def legacy_normalize(sentence: str) -> str:
+    # Normalization as it was done before normalizer.py, kept as a reference
+    sentence = re.sub(re.compile(r"<[^>]*>"), " ", sentence)
+    sentence = re.sub(re.compile(r"^\[id\d*|.*\],*\s*"), "", sentence)
+    sentence = re.sub(re.compile(r"(&quot;)|(&lt;)|(&gt;)|(&amp;)|(&apos;)"), " ", sentence)
+    sentence = re.sub(re.compile(
+        r"https?://(www\.)?[-a-zA-Z0-9@:%._+~#=]{2,256}\.[a-z]{2,6}\b([-a-zA-Z0-9@:%_+.~#?&/=]*)")," ", sentence)
+    sentence = re.sub(re.compile(r"\[[^\[\]]+\|([^\[\]]+)\]"), r"\1", sentence)
+    sentence = re.sub(re.compile(r"(&#\d+;)"), " ", sentence)
+    sentence = re.sub(re.compile(r"[(_#*=^/`@«»©…“•—<>\[\]\"'+%|&]"), " ", sentence)
+    sentence = re.sub(re.compile(r"[.,!?\;:)(_#*=^/`@«»©…“•—<>\[\]\"'+%|&]"), " ", sentence)
+    sentence = sentence.replace("  ", " ")
+    sentence = sentence.replace("--", " ")
+    sentence = sentence.replace('\n', ' ')
+    sentence = re.sub("\s\s+", " ", sentence)
+    sentence = sentence.lower()
+    return sentence
+
+
+def normalize_report(messages):
+    for message in messages:
+        assert normalize(message) == legacy_normalize(message), message
+    result = dict()
+    for name, function in [("legacy", legacy_normalize), ("normalizer", normalize)]:
+        start = time.perf_counter()
+        for message in messages:
+            function(message)
+        result[name + "_us_per_message"] = (time.perf_counter() - start) / len(messages) * 1e6
+        print("{:>10}: {:.1f} us/msg".format(name, result[name + "_us_per_message"]))
+    return result
+
+
+def cpu_time_per_message(messages, batch_size, dynamic_padding):
+    start = time.process_time()
+    for i in range(0, len(messages), batch_size):
+        checker.score_batch(messages[i:i + batch_size], dynamic_padding=dynamic_padding)
+    return (time.process_time() - start) / len(messages)
+
+
+def padding_report(messages, batch_sizes):
+    result = dict()
+    for batch_size in batch_sizes:
+        before = cpu_time_per_message(messages, batch_size, False)
+        after = cpu_time_per_message(messages, batch_size, True)
+        result[batch_size] = {"max_length_ms_per_message": before * 1000, "dynamic_ms_per_message": after * 1000}
+        print("batch {:>3}: max_length padding {:.2f} ms/msg, dynamic padding {:.2f} ms/msg ({:.1f}x)".format(
+            batch_size, before * 1000, after * 1000, before / after))
+    return result
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q / 100 * len(values)))]
+
+
+def latency_report(messages):
+    latencies = []
+    for message in messages:
+        start = time.perf_counter()
+        checker.score_batch([message])
+        latencies.append((time.perf_counter() - start) * 1000)
+    result = {"p%d_ms" % q: percentile(latencies, q) for q in [50, 95, 99]}
+    result["mean_ms"] = statistics.mean(latencies)
+    print("latency: p50 {p50_ms:.2f} ms, p95 {p95_ms:.2f} ms, p99 {p99_ms:.2f} ms".format(**result))
+    return result
+
+
+def throughput(messages, batch_size):
+    start = time.perf_counter()
+    for i in range(0, len(messages), batch_size):
+        checker.score_batch(messages[i:i + batch_size])
+    return len(messages) / (time.perf_counter() - start)
+
+
+def batch_size_report(messages, batch_sizes):
+    result = dict()
+    for batch_size in batch_sizes:
+        result[batch_size] = throughput(messages, batch_size)
+        print("batch {:>3}: {:.1f} msg/s".format(batch_size, result[batch_size]))
+    return result
+
+
+def sequence_length_report(count, lengths, batch_size):
+    # Messages of exactly `length` tokens, including [CLS] and [SEP]
+    result = dict()
+    for length in lengths:
+        ids = [[checker.tokenizer.cls_token_id] + [checker.tokenizer.convert_tokens_to_ids(words[0])] * (length - 2) + [checker.tokenizer.sep_token_id]] * batch_size
+        input_ids = np.array(ids, dtype=np.int64)
+        attention_mask = np.ones_like(input_ids)
+        checker.forward(input_ids, attention_mask)
+        start = time.perf_counter()
+        for _ in range(max(1, count // batch_size)):
+            checker.forward(input_ids, attention_mask)
+        result[length] = max(1, count // batch_size) * batch_size / (time.perf_counter() - start)
+        print("{:>3} tokens: {:.1f} msg/s".format(length, result[length]))
+    return result
+
+
+def threads_report(messages, thread_counts, batch_size):
+    result = dict()
+    default = torch.get_num_threads()
+    for threads in thread_counts:
+        torch.set_num_threads(threads)
+        result[threads] = throughput(messages, batch_size)
+        print("{:>3} threads: {:.1f} msg/s".format(threads, result[threads]))
+    torch.set_num_threads(default)
+    return result
+
+
+def cold_start_report(model, backend, runs):
+    # Every run is a new interpreter, so imports, weight loading and warm-up are included
+    code = ("import time, resource; start = time.perf_counter(); import checker; checker.load(%r, backend=%r); "
+            "print(time.perf_counter() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)") % (model, backend)
+    times = []
+    peak_rss = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True).stdout
+        seconds, rss = output.strip().split("\n")[-1].split()
+        times.append(float(seconds))
+        # ru_maxrss is in kilobytes on Linux
+        peak_rss.append(int(rss) / 1024)
+    result = {"min_s": min(times), "mean_s": statistics.mean(times), "peak_rss_mb": max(peak_rss)}
+    print("checker.load: min {min_s:.2f} s, mean {mean_s:.2f} s, peak RSS {peak_rss_mb:.0f} MB".format(**result))
+    return result
+
+
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = ""
+    return {
+        "commit": commit,
+        "host": platform.node(),
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "threads": torch.get_num_threads(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Measure checker inference cost")
+    parser.add_argument("--model", default="./model")
+    parser.add_argument("--backend", default="torch")
+    parser.add_argument("--messages", type=int, default=1000)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 8, 32, 64])
+    parser.add_argument("--lengths", type=int, nargs="+", default=[8, 16, 32, 64, 128])
+    parser.add_argument("--threads", type=int, nargs="+", default=sorted({1, 2, 4, os.cpu_count() or 1}))
+    parser.add_argument("--cold-starts", type=int, default=3)
+    parser.add_argument("--output", default="benchmark.json", help="machine-readable results")
+    args = parser.parse_args()
+
+    messages = synthetic_messages(args.messages)
+    results = {"environment": environment(), "backend": args.backend, "messages": args.messages}
+    results["normalize"] = normalize_report(messages)
+    messages = normalize_batch(messages)
+    results["cold_start"] = cold_start_report(args.model, args.backend, args.cold_starts)
+    checker.load(args.model, max_batch_size=1, backend=args.backend)
+    results["latency"] = latency_report(messages)
+    results["batch_size"] = batch_size_report(messages, args.batch_sizes)
+    results["sequence_length"] = sequence_length_report(args.messages, args.lengths, 32)
+    results["threads"] = threads_report(messages, args.threads, 32)
+    results["padding"] = padding_report(messages, [1, 8, 32])
+
+    with open(args.output, "w") as file:
+        json.dump(results, file, indent=2)
+    print("Results written to", args.output)
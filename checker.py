@@ -1,84 +1,274 @@
-import torch
 import numpy as np
-import pandas as pd
-from transformers import AutoTokenizer, AutoModelForPreTraining, BertForSequenceClassification
-import re
-import asyncio
+import os
+import time
+import logging
+import itertools
 import threading
+import hashlib
+from concurrent.futures import Future
+from typing import List
+
+from batcher import BatchScorer
+from workers import ProcessScorer
+from cache import TTLCache
+from normalizer import normalize
+import metrics
+
+logger = logging.getLogger(__name__)
 
 model = None
+session = None
 tokenizer = None
 device = None
+batcher = None
+pool = None
 model_semaphore = threading.Semaphore(1)
+# Set once the model is loaded and warmed up, messages submitted earlier wait for it.
+# Also set when loading fails, load_error then holds the exception and scoring raises it.
+ready = threading.Event()
+load_error = None
+# Padded sequence lengths used when batching messages of different length
+length_buckets = [8, 16, 32, 64, 128]
+# Longer messages are scored in windows of max_length tokens overlapping by window_overlap,
+# at most max_windows per message, and the window scores are combined with window_aggregate
+max_length = 128
+window_overlap = 32
+max_windows = 8
+window_aggregate = max
+onnx_file = "model.onnx"
+quantized_file = "quantized.pt"
+# Scores of recently seen messages keyed by a hash of their normalized text
+cache = TTLCache(maxsize=100000, ttl=24 * 60 * 60)
+# Decides obviously clean and obviously toxic messages without the model, None disables it.
+# Off until prefilter.py's agreement report has been checked on labeled data, since its
+# toxic verdicts override every chat's tox_level.
+prefilter = None
 
 
-def load(path):
-    global model, tokenizer, device
-    # If there's a GPU available...
-    if torch.cuda.is_available():    
-
-        # Tell PyTorch to use the GPU.    
-        device = torch.device("cuda")
+def load(path, max_batch_size=32, max_wait=0.005, processes=0, threads=None, backend="torch", background=False):
+    global batcher, pool, load_error
+    # Workers would be forked from the loader thread while the batcher thread runs
+    if background and processes > 0:
+        raise ValueError("Scoring processes can't be started by a background load")
+    if batcher:
+        batcher.stop()
+        batcher = None
+    if pool:
+        pool.stop()
+        pool = None
+    ready.clear()
+    load_error = None
+    # Scores from the previous model are no longer valid
+    cache.clear()
+    if background:
+        # Messages from all chats are collected for up to max_wait seconds and scored together.
+        batcher = BatchScorer(dispatch, max_batch_size, max_wait)
+        threading.Thread(target=load_in_background, args=(path, processes, threads, backend), name="ModelLoader", daemon=True).start()
+    else:
+        # Scoring processes are forked here, before the batcher thread starts
+        load_model(path, processes, threads, backend)
+        batcher = BatchScorer(dispatch, max_batch_size, max_wait)
 
-        print('There are %d GPU(s) available.' % torch.cuda.device_count())
+def load_in_background(path, processes=0, threads=None, backend="torch"):
+    global load_error
+    try:
+        load_model(path, processes, threads, backend)
+    except Exception as e:
+        logger.exception("Failed to load the model from %s", path)
+        load_error = e
+        ready.set()
 
-        print('We will use the GPU:', torch.cuda.get_device_name(0))
+def load_model(path, processes=0, threads=None, backend="torch"):
+    global model, session, tokenizer, device, pool
+    # torch and transformers are imported here so that the bot starts without waiting for them
+    from transformers import AutoTokenizer
+    start = time.perf_counter()
+    model = None
+    session = None
 
-    # If not...
-    else:
-        print('No GPU available, using the CPU instead.')
+    if backend == "onnx":
+        # Model exported with export_onnx.py, runs on CPU only.
+        # onnxruntime thread pools don't survive fork, so scoring workers create their own session.
+        device = "cpu"
+        if processes == 0:
+            print('Loading ONNX model...')
+            session = onnx_session(path, threads)
+    elif backend == "quantized":
+        # Linear layers with int8 weights, runs on CPU only
+        import torch
+        print('Loading quantized model...')
         device = torch.device("cpu")
+        model = load_quantized(path)
+    elif backend == "torch":
+        import torch
+        from transformers import BertForSequenceClassification
+        # If there's a GPU available...
+        if torch.cuda.is_available():    
+
+            # Tell PyTorch to use the GPU.    
+            device = torch.device("cuda")
+
+            print('There are %d GPU(s) available.' % torch.cuda.device_count())
+
+            print('We will use the GPU:', torch.cuda.get_device_name(0))
 
-    model = BertForSequenceClassification.from_pretrained(
-        path, # Use the 12-layer BERT model, with an uncased vocab.
-        num_labels = 2, # The number of output labels--2 for binary classification.
-                        # You can increase this for multi-class tasks.   
-        output_attentions = False, # Whether the model returns attentions weights.
-        output_hidden_states = False, # Whether the model returns all hidden-states.
-    )
+        # If not...
+        else:
+            print('No GPU available, using the CPU instead.')
+            device = torch.device("cpu")
+
+        # Weights in safetensors format are memory-mapped instead of read and copied,
+        # older pytorch_model.bin weights can be converted with: python convert_weights.py ./model
+        if not os.path.exists(os.path.join(path, "model.safetensors")):
+            logger.warning("No model.safetensors in %s, loading pytorch_model.bin", path)
+        model = BertForSequenceClassification.from_pretrained(
+            path, # Use the 12-layer BERT model, with an uncased vocab.
+            num_labels = 2, # The number of output labels--2 for binary classification.
+                            # You can increase this for multi-class tasks.   
+            output_attentions = False, # Whether the model returns attentions weights.
+            output_hidden_states = False, # Whether the model returns all hidden-states.
+        )
+
+        # Tell pytorch to run this model on the GPU.
+        model.to(device)
+        model.eval()
+    else:
+        raise ValueError("Unknown backend " + backend)
 
     # Load the BERT tokenizer.
     print('Loading BERT tokenizer...')
     tokenizer = AutoTokenizer.from_pretrained(path, do_lower_case=True)
 
-    # Tell pytorch to run this model on the GPU.
-    model.to(device)
-
-def preprocess(sentence: str) -> str:
-    sentence = re.sub(re.compile(r"<[^>]*>"), " ", sentence)
-    sentence = re.sub(re.compile(r"^\[id\d*|.*\],*\s*"), "", sentence)
-    sentence = re.sub(re.compile(r"(&quot;)|(&lt;)|(&gt;)|(&amp;)|(&apos;)"), " ", sentence)
-    sentence = re.sub(re.compile(
-        r"https?://(www\.)?[-a-zA-Z0-9@:%._+~#=]{2,256}\.[a-z]{2,6}\b([-a-zA-Z0-9@:%_+.~#?&/=]*)")," ", sentence)
-    sentence = re.sub(re.compile(r"\[[^\[\]]+\|([^\[\]]+)\]"), r"\1", sentence)
-    sentence = re.sub(re.compile(r"(&#\d+;)"), " ", sentence)
-    sentence = re.sub(re.compile(r"[(_#*=^/`@«»©…“•—<>\[\]\"'+%|&]"), " ", sentence)
-    sentence = re.sub(re.compile(r"[.,!?\;:)(_#*=^/`@«»©…“•—<>\[\]\"'+%|&]"), " ", sentence)
-    sentence = sentence.replace("  ", " ")
-    sentence = sentence.replace("--", " ")
-    sentence = sentence.replace('\n', ' ')
-    sentence = re.sub("\s\s+", " ", sentence)
-    sentence = sentence.lower()
-    return sentence
-
-
-def score(sentence: str):
-    global model_semaphore
-    with torch.no_grad():
-        input_ids = tokenizer.encode_plus(
-                        sentence,
-                        add_special_tokens=True,
-                        max_length=128,
-                        padding='max_length',
-                        return_attention_mask=False,
-                        return_tensors='pt'
-                    )
-        model_semaphore.acquire()    
-        input_ids = input_ids.to(device)
-        if len(input_ids["input_ids"][0]) > 128:
-            return 0
-        result = model(**input_ids)
-        answer = result['logits'].softmax(1).to('cpu').detach().numpy()
-        model_semaphore.release()
-        return answer[0][1]
+    # With processes > 0 batches are scored by forked workers sharing the weights loaded above,
+    # each worker warms up on its own
+    if processes > 0 and backend == "onnx":
+        pool = ProcessScorer(score_batch, processes, threads, initialize=lambda threads: init_onnx_worker(path, threads))
+    elif processes > 0:
+        pool = ProcessScorer(score_batch, processes, threads)
+    else:
+        score_batch(["прогрев модели"])
+    ready.set()
+    logger.info("Model ready in %.1f s", time.perf_counter() - start)
+
+def onnx_session(path, threads=None):
+    import onnxruntime
+    options = onnxruntime.SessionOptions()
+    if threads:
+        options.intra_op_num_threads = threads
+    return onnxruntime.InferenceSession(os.path.join(path, onnx_file), sess_options=options, providers=["CPUExecutionProvider"])
+
+def init_onnx_worker(path, threads):
+    global session
+    session = onnx_session(path, threads)
+
+def dispatch(sentences: List[str]):
+    ready.wait()
+    if load_error is not None:
+        raise RuntimeError("The model failed to load") from load_error
+    return pool.submit(sentences) if pool else score_batch(sentences)
+
+def load_quantized(path):
+    """Loads the int8 model cached next to the weights, quantizing it first if it is missing or stale."""
+    import torch
+    from transformers import BertForSequenceClassification
+    quantized_path = os.path.join(path, quantized_file)
+    sources = [os.path.join(path, name) for name in ["config.json", "pytorch_model.bin", "model.safetensors"]]
+    updated = max(os.path.getmtime(source) for source in sources if os.path.exists(source))
+    if os.path.exists(quantized_path) and os.path.getmtime(quantized_path) >= updated:
+        quantized = torch.load(quantized_path, weights_only=False)
+    else:
+        print('Quantizing model...')
+        quantized = torch.quantization.quantize_dynamic(
+            BertForSequenceClassification.from_pretrained(path, num_labels=2),
+            {torch.nn.Linear},
+            dtype=torch.qint8,
+        )
+        torch.save(quantized, quantized_path)
+    quantized.eval()
+    return quantized
+
+def forward(input_ids: np.ndarray, attention_mask: np.ndarray) -> np.ndarray:
+    """Returns the probability of the toxic class for a padded batch."""
+    metrics.batch_size.observe(len(input_ids))
+    with model_semaphore, metrics.model_seconds.time():
+        if session:
+            logits = session.run(["logits"], {"input_ids": input_ids.astype(np.int64), "attention_mask": attention_mask.astype(np.int64)})[0]
+            logits = logits - logits.max(axis=1, keepdims=True)
+            probs = np.exp(logits)
+            return probs[:, 1] / probs.sum(axis=1)
+        import torch
+        with torch.no_grad():
+            logits = model(input_ids=torch.from_numpy(input_ids).to(device), attention_mask=torch.from_numpy(attention_mask).to(device))['logits']
+        return logits.softmax(1)[:, 1].to('cpu').numpy()
+
+
+def bucket(length: int) -> int:
+    for size in length_buckets:
+        if length <= size:
+            return size
+    return length
+
+
+def windows(ids: List[int]) -> List[List[int]]:
+    """Splits an encoded message longer than the model input into overlapping windows."""
+    if len(ids) <= max_length:
+        return [ids]
+    cls, content, sep = ids[:1], ids[1:-1], ids[-1:]
+    size = max_length - 2
+    step = size - window_overlap
+    return [cls + content[start:start + size] + sep for start in range(0, len(content) - window_overlap, step)]
+
+
+def score_batch(sentences: List[str], dynamic_padding: bool = True) -> List[float]:
+    # Long messages are cut to max_windows windows so that one paste can't hold up the model
+    max_tokens = max_length + (max_windows - 1) * (max_length - 2 - window_overlap)
+    with metrics.tokenize_seconds.time():
+        encoded = tokenizer(sentences, add_special_tokens=True, truncation=True, max_length=max_tokens)["input_ids"]
+    # Windows of all messages are scored together, then combined per message
+    items = [(i, ids) for i, message in enumerate(encoded) for ids in windows(message)]
+    # Messages of similar length are run together and padded only to the longest one of them
+    items.sort(key=lambda item: len(item[1]))
+    groups = itertools.groupby(items, key=lambda item: bucket(len(item[1])) if dynamic_padding else max_length)
+    scores = [[] for _ in sentences]
+    for _, group in groups:
+        group = list(group)
+        with metrics.tokenize_seconds.time():
+            input_ids = tokenizer.pad(
+                            {"input_ids": [ids for _, ids in group]},
+                            max_length=max_length,
+                            padding='longest' if dynamic_padding else 'max_length',
+                            return_attention_mask=True,
+                            return_tensors='np'
+                        )
+        answer = forward(input_ids["input_ids"], input_ids["attention_mask"])
+        for (i, _), p in zip(group, answer):
+            scores[i].append(float(p))
+    return [window_aggregate(score) if score else 0.0 for score in scores]
+
+
+def cache_key(sentence: str) -> bytes:
+    return hashlib.blake2b(sentence.encode(), digest_size=16).digest()
+
+
+def submit(sentence: str) -> Future:
+    # The model was trained on normalized text
+    sentence = normalize(sentence)
+    verdict = prefilter.check(sentence) if prefilter else None
+    if verdict is not None:
+        metrics.prefilter.inc(verdict="toxic" if verdict else "clean")
+        future = Future()
+        future.set_result(verdict)
+        return future
+    key = cache_key(sentence)
+    cached = cache.get(key)
+    if cached is not None:
+        future = Future()
+        future.set_result(cached)
+        return future
+    future = batcher.submit(sentence)
+    future.add_done_callback(lambda f: cache.put(key, f.result()) if not f.cancelled() and f.exception() is None else None)
+    return future
+
 
+def score(sentence: str) -> float:
+    return submit(sentence).result()
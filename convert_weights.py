@@ -0,0 +1,30 @@
+import argparse
+import os
+
+import torch
+from safetensors.torch import save_file
+
+
+def convert(path: str) -> bool:
+    """Writes pytorch_model.bin weights as model.safetensors next to them, other files are left untouched.
+
+    config.json is not rewritten, so the quantized model cached by checker.py stays valid.
+    """
+    output = os.path.join(path, "model.safetensors")
+    weights = os.path.join(path, "pytorch_model.bin")
+    if os.path.exists(output) or not os.path.exists(weights):
+        return False
+    state = torch.load(weights, map_location="cpu", weights_only=True)
+    save_file({name: tensor.contiguous() for name, tensor in state.items()}, output, metadata={"format": "pt"})
+    return True
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Convert model weights to safetensors so that the bot memory-maps them")
+    parser.add_argument("model", nargs="?", default="./model")
+    args = parser.parse_args()
+
+    if convert(args.model):
+        print("Wrote", os.path.join(args.model, "model.safetensors"))
+    else:
+        print("Nothing to convert in", args.model)
@@ -0,0 +1,242 @@
+from typing import Tuple
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import itertools
+import hashlib
+import bisect
+import inspect
+import json
+import shutil
+import os
+
+import numpy as np
+
+import normalizer
+
+# Bump when the layout of the files below changes
+version = 2
+
+# Tokenizer used by encode_chunk, set in every worker process
+chunk_tokenizer = None
+
+
+def file_hash(path: str) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def cache_key(csv_path: str, tokenizer, max_length: int) -> str:
+    """Changes whenever the data, the tokenizer or normalization would produce a different dataset."""
+    digest = hashlib.blake2b(digest_size=16)
+    vocab = sorted(tokenizer.get_vocab().items())
+    for part in [str(version), file_hash(csv_path), tokenizer.__class__.__name__, json.dumps(vocab, ensure_ascii=False),
+                 str(getattr(tokenizer, "do_lower_case", "")), inspect.getsource(normalizer), str(max_length)]:
+        digest.update(part.encode())
+    return digest.hexdigest()
+
+
+def encode_chunk(comments, toxic, max_length: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Normalizes and tokenizes a chunk of the CSV, returns flat token ids, lengths and labels of the kept messages."""
+    sentences = normalizer.normalize_batch([comment.replace('\n', '.') for comment in comments])
+    encoded = chunk_tokenizer(sentences, add_special_tokens=True)["input_ids"]
+    keep = [i for i, example in enumerate(encoded) if len(example) <= max_length]
+    lengths = np.array([len(encoded[i]) for i in keep], dtype=np.int16)
+    ids = np.fromiter(itertools.chain.from_iterable(encoded[i] for i in keep), dtype=np.int32, count=int(lengths.sum()))
+    labels = (np.asarray(toxic)[keep] == 1).astype(np.int8)
+    return ids, lengths, labels
+
+
+def set_tokenizer(tokenizer):
+    global chunk_tokenizer
+    chunk_tokenizer = tokenizer
+
+
+def write_shard(path: str, ids: np.ndarray, lengths: np.ndarray, labels: np.ndarray):
+    os.makedirs(path)
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    np.save(os.path.join(path, "ids.npy"), ids)
+    np.save(os.path.join(path, "offsets.npy"), offsets)
+    np.save(os.path.join(path, "lengths.npy"), lengths)
+    np.save(os.path.join(path, "labels.npy"), labels)
+
+
+def build(csv_path: str, tokenizer, output: str, max_length: int = 128, chunk_size: int = 100000, processes: int = None) -> int:
+    """Normalizes and tokenizes the labeled CSV and writes the token ids, lengths and labels to output.
+
+    The CSV is read chunk_size rows at a time, chunks are encoded by a pool of processes and
+    each one is written as a shard as soon as it is done, so memory use depends on chunk_size
+    and processes rather than on the size of the CSV. Messages longer than max_length tokens
+    are left out. Returns the number of examples.
+    """
+    import pandas as pd
+    processes = (os.cpu_count() or 1) if processes is None else processes
+    # Written to a temporary directory of this process first so that an interrupted build
+    # is never picked up and concurrent builds don't overwrite each other's shards
+    temporary = "%s.%d.tmp" % (output, os.getpid())
+    shutil.rmtree(temporary, ignore_errors=True)
+    os.makedirs(temporary)
+    chunks = pd.read_csv(csv_path, chunksize=chunk_size, usecols=["comment", "toxic"])
+    count = 0
+    shards = 0
+
+    def write(result):
+        nonlocal count, shards
+        ids, lengths, labels = result
+        write_shard(os.path.join(temporary, "%05d" % shards), ids, lengths, labels)
+        count += len(labels)
+        shards += 1
+        print('  {:,} examples in {} shards'.format(count, shards))
+
+    if processes:
+        # Workers are forked so that the tokenizer and the normalizer are not imported again.
+        # Only a few chunks are read ahead of the shard being written.
+        context = multiprocessing.get_context("fork")
+        with ProcessPoolExecutor(processes, mp_context=context, initializer=set_tokenizer, initargs=(tokenizer,)) as executor:
+            pending = deque()
+            for chunk in chunks:
+                pending.append(executor.submit(encode_chunk, chunk.comment.values, chunk.toxic.values, max_length))
+                if len(pending) > 2 * processes:
+                    write(pending.popleft().result())
+            while pending:
+                write(pending.popleft().result())
+    else:
+        set_tokenizer(tokenizer)
+        for chunk in chunks:
+            write(encode_chunk(chunk.comment.values, chunk.toxic.values, max_length))
+    try:
+        os.rename(temporary, output)
+    except OSError:
+        # Another process finished the same build first
+        if not os.path.exists(output):
+            raise
+        shutil.rmtree(temporary)
+    return count
+
+
+class TokenDataset():
+    """Examples of a built dataset, read from memory-mapped shards."""
+
+    def __init__(self, path: str):
+        shards = [os.path.join(path, name) for name in sorted(os.listdir(path))]
+        self.ids = [np.load(os.path.join(shard, "ids.npy"), mmap_mode="r") for shard in shards]
+        self.offsets = [np.load(os.path.join(shard, "offsets.npy"), mmap_mode="r") for shard in shards]
+        self.labels = [np.load(os.path.join(shard, "labels.npy"), mmap_mode="r") for shard in shards]
+        # Lengths of all examples are kept in memory, two bytes each, for batching by length
+        self.lengths = np.concatenate([np.load(os.path.join(shard, "lengths.npy")) for shard in shards] or [np.zeros(0, np.int16)])
+        # Index of the first example of every shard
+        self.starts = [0]
+        for labels in self.labels:
+            self.starts.append(self.starts[-1] + len(labels))
+
+    def __len__(self):
+        return self.starts[-1]
+
+    def __getitem__(self, index: int) -> Tuple[np.ndarray, int]:
+        if index < 0:
+            index += len(self)
+        shard = bisect.bisect_right(self.starts, index) - 1
+        index -= self.starts[shard]
+        offsets = self.offsets[shard]
+        return self.ids[shard][offsets[index]:offsets[index + 1]], int(self.labels[shard][index])
+
+
+def load(csv_path: str, tokenizer, cache_dir: str = "./dataset", max_length: int = 128, chunk_size: int = 100000, processes: int = None) -> TokenDataset:
+    """Opens the dataset built from csv_path, building it first if the inputs changed since the last build."""
+    path = os.path.join(cache_dir, cache_key(csv_path, tokenizer, max_length))
+    if not os.path.exists(path):
+        print('Building dataset in {}...'.format(path))
+        build(csv_path, tokenizer, path, max_length, chunk_size, processes)
+    return TokenDataset(path)
+
+
+def collate(batch, max_length: int = None, pad_token_id: int = 0):
+    """Pads a list of (ids, label) examples into input ids, attention mask and labels tensors.
+
+    Pads to max_length if given, otherwise to the longest example of the batch.
+    """
+    import torch
+    length = max_length or max(len(ids) for ids, _ in batch)
+    input_ids = torch.full((len(batch), length), pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(batch), length), dtype=torch.long)
+    for row, (ids, _) in enumerate(batch):
+        input_ids[row, :len(ids)] = torch.from_numpy(ids.astype(np.int64))
+        attention_mask[row, :len(ids)] = 1
+    labels = torch.tensor([label for _, label in batch])
+    return input_ids, attention_mask, labels
+
+
+class BucketBatchSampler():
+    """Yields batches of indices of examples with similar length, so that little of a batch is padding.
+
+    With shuffle, examples are shuffled and sorted by length within pools of pool_size batches,
+    and the batches are shuffled again, so batch order and content still change every epoch.
+    With num_replicas > 1 every process takes every num_replicas-th batch. When shuffling, batches
+    are repeated so that every process gets the same number, as gradient all-reduce needs.
+    """
+
+    def __init__(self, lengths: np.ndarray, batch_size: int, shuffle: bool = True, pool_size: int = 100, seed: int = 42,
+                 num_replicas: int = 1, rank: int = 0):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.pool_size = pool_size
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def __len__(self):
+        batches = (len(self.lengths) + self.batch_size - 1) // self.batch_size
+        if self.shuffle:
+            return (batches + self.num_replicas - 1) // self.num_replicas
+        return len(range(self.rank, batches, self.num_replicas))
+
+    def batches(self) -> list:
+        if not self.shuffle:
+            order = np.argsort(self.lengths, kind="stable")
+            batches = [order[start:start + self.batch_size] for start in range(0, len(order), self.batch_size)]
+            return batches[self.rank::self.num_replicas]
+        # Every process draws the same permutation
+        rng = np.random.default_rng(self.seed + self.epoch)
+        order = rng.permutation(len(self.lengths))
+        pool = self.batch_size * self.pool_size
+        batches = []
+        for start in range(0, len(order), pool):
+            chunk = order[start:start + pool]
+            chunk = chunk[np.argsort(self.lengths[chunk], kind="stable")]
+            batches += [chunk[i:i + self.batch_size] for i in range(0, len(chunk), self.batch_size)]
+        batches = [batches[i] for i in rng.permutation(len(batches))]
+        while len(batches) % self.num_replicas:
+            batches += batches[:self.num_replicas - len(batches) % self.num_replicas]
+        return batches[self.rank::self.num_replicas]
+
+    def __iter__(self):
+        for batch in self.batches():
+            yield batch.tolist()
+        self.epoch += 1
+
+
+if __name__ == '__main__':
+    import argparse
+    from transformers import AutoTokenizer
+
+    parser = argparse.ArgumentParser(description="Build the tokenized training set ahead of train.py")
+    parser.add_argument("data", nargs="?", default="./train.csv")
+    parser.add_argument("--model-name", default="cointegrated/rubert-tiny", help="model whose tokenizer is used")
+    parser.add_argument("--cache-dir", default="./dataset")
+    parser.add_argument("--max-length", type=int, default=128)
+    parser.add_argument("--chunk-size", type=int, default=100000, help="CSV rows read and encoded at a time")
+    parser.add_argument("--workers", type=int, default=None, help="encoding processes, 0 encodes in this process")
+    args = parser.parse_args()
+
+    data = load(args.data, AutoTokenizer.from_pretrained(args.model_name, do_lower_case=True), args.cache_dir,
+                args.max_length, args.chunk_size, args.workers)
+    print('{:,} examples, {:,} tokens'.format(len(data), int(data.lengths.sum(dtype=np.int64))))
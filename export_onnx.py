@@ -0,0 +1,65 @@
+import argparse
+import os
+
+import numpy as np
+import onnxruntime
+import torch
+from transformers import AutoTokenizer, BertForSequenceClassification
+
+import checker
+from normalizer import normalize
+
+check_sentences = [
+    "привет",
+    "спасибо большое за помощь",
+    "ну ты и дурак конечно",
+    "кто-нибудь знает во сколько завтра начинается встреча в чате админов",
+]
+
+
+def export(path: str, output: str):
+    model = BertForSequenceClassification.from_pretrained(path, num_labels=2)
+    model.eval()
+    tokenizer = AutoTokenizer.from_pretrained(path, do_lower_case=True)
+    sample = tokenizer(check_sentences, padding='longest', return_tensors='pt')
+    torch.onnx.export(
+        model,
+        (sample["input_ids"], sample["attention_mask"]),
+        output,
+        input_names=["input_ids", "attention_mask"],
+        output_names=["logits"],
+        # Batch size and sequence length vary between calls
+        dynamic_axes={
+            "input_ids": {0: "batch", 1: "sequence"},
+            "attention_mask": {0: "batch", 1: "sequence"},
+            "logits": {0: "batch"},
+        },
+        opset_version=13,
+    )
+    return model, tokenizer
+
+
+def check(model, tokenizer, output: str, tolerance: float) -> float:
+    """Returns the largest difference between torch and ONNX Runtime probabilities."""
+    session = onnxruntime.InferenceSession(output, providers=["CPUExecutionProvider"])
+    inputs = tokenizer([normalize(s) for s in check_sentences], padding='longest', return_tensors='np')
+    with torch.no_grad():
+        expected = model(input_ids=torch.from_numpy(inputs["input_ids"]), attention_mask=torch.from_numpy(inputs["attention_mask"]))["logits"].softmax(1).numpy()
+    logits = session.run(["logits"], {"input_ids": inputs["input_ids"].astype(np.int64), "attention_mask": inputs["attention_mask"].astype(np.int64)})[0]
+    actual = torch.from_numpy(logits).softmax(1).numpy()
+    difference = float(np.abs(expected - actual).max())
+    if difference > tolerance:
+        raise RuntimeError("ONNX model differs from torch model by %g (tolerance %g)" % (difference, tolerance))
+    return difference
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Export the fine-tuned model to ONNX for checker.load(backend='onnx')")
+    parser.add_argument("--model", default="./model")
+    parser.add_argument("--tolerance", type=float, default=1e-4)
+    args = parser.parse_args()
+
+    output = os.path.join(args.model, checker.onnx_file)
+    model, tokenizer = export(args.model, output)
+    print("Exported", output)
+    print("Max probability difference: {:.2e}".format(check(model, tokenizer, output, args.tolerance)))
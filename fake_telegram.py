@@ -0,0 +1,239 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from collections import Counter, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+import urllib.request
+import argparse
+import random
+import threading
+import json
+import time
+import re
+
+me = {"id": 1, "is_bot": True, "first_name": "DetoxificationBot", "username": "detoxification_bot"}
+texts = ["привет всем", "ок", "спасибо", "кто идёт завтра?", "ну ты и дурак", "лол", "да ладно", "отстань уже, надоел"]
+
+
+class FakeBotAPI(ThreadingHTTPServer):
+    """Answers the Bot API methods used by the bot and counts the calls.
+
+    Start the bot with base_url pointing here, e.g. http://127.0.0.1:8081/bot
+    With limits, calls over Telegram's flood limits are answered with 429 and retry_after.
+    """
+
+    daemon_threads = True
+    # sendMessage calls per minute to one chat and calls per second overall
+    chat_limit = 20
+    global_limit = 30
+
+    def __init__(self, host: str, port: int, latency: float = 0.0, limits: bool = False):
+        super().__init__((host, port), FakeBotAPIHandler)
+        self.latency = latency
+        self.limits = limits
+        self.calls = Counter()
+        self.lock = threading.Lock()
+        self.chat_calls = defaultdict(deque)
+        self.global_calls = deque()
+
+    def retry_after(self, method: str, chat_id) -> int:
+        """Records the call and returns 0, or the seconds to wait if it is over a limit."""
+        now = time.monotonic()
+        with self.lock:
+            calls = [(self.global_calls, 1, self.global_limit)]
+            if method == "sendMessage":
+                calls.append((self.chat_calls[chat_id], 60, self.chat_limit))
+            for times, window, limit in calls:
+                while times and times[0] <= now - window:
+                    times.popleft()
+                if len(times) >= limit:
+                    self.calls["429"] += 1
+                    return max(1, int(times[0] + window - now + 1))
+            for times, _, _ in calls:
+                times.append(now)
+        return 0
+
+
+class FakeBotAPIHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        self.handle_method()
+
+    def do_GET(self):
+        self.handle_method()
+
+    def handle_method(self):
+        method = self.path.rsplit("/", 1)[-1]
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        with self.server.lock:
+            self.server.calls[method] += 1
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        params = json.loads(body) if body.startswith(b"{") else dict()
+        retry_after = self.server.retry_after(method, params.get("chat_id")) if self.server.limits else 0
+        if retry_after:
+            self.respond({"ok": False, "error_code": 429, "description": "Too Many Requests: retry after %d" % retry_after,
+                          "parameters": {"retry_after": retry_after}}, 429)
+            return
+        if method == "getMe":
+            result = me
+        elif method == "getChatMember":
+            result = {"user": {"id": int(params.get("user_id", 2)), "is_bot": False, "first_name": "User", "username": "user"}, "status": "member"}
+        elif method == "sendMessage":
+            result = {"message_id": random.randint(1, 2**31), "date": int(time.time()), "chat": {"id": int(params.get("chat_id", 0)), "type": "supergroup"}, "text": params.get("text", "")}
+        else:
+            result = True
+        self.respond({"ok": True, "result": result})
+
+    def respond(self, answer: dict, status: int = 200):
+        response = json.dumps(answer).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def generate(count: int, chats: int, users: int, seed: int = 42):
+    """Group message updates like the ones Telegram sends to the webhook."""
+    rng = random.Random(seed)
+    for update_id in range(1, count + 1):
+        chat_id = -1000000000000 - rng.randrange(chats)
+        user_id = 100 + rng.randrange(users)
+        yield {
+            "update_id": update_id,
+            "message": {
+                "message_id": update_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "supergroup", "title": "Chat %d" % chat_id},
+                "from": {"id": user_id, "is_bot": False, "first_name": "User", "username": "user%d" % user_id},
+                "text": rng.choice(texts),
+            },
+        }
+
+
+def scored(metrics_url: str) -> float:
+    text = urllib.request.urlopen(metrics_url).read().decode()
+    match = re.search(r'^bot_messages_total\{outcome="scored"\} (\S+)$', text, re.MULTILINE)
+    return float(match.group(1)) if match else 0.0
+
+
+def post(url: str, update: dict) -> bool:
+    request = urllib.request.Request(url, json.dumps(update).encode(), {"Content-Type": "application/json"})
+    try:
+        urllib.request.urlopen(request).read()
+        return True
+    except urllib.error.HTTPError:
+        return False
+
+
+def replay(updates, url: str, rate: float = 0.0, concurrency: int = 8, metrics_url: str = None):
+    """POSTs updates to the webhook and reports how fast they were accepted and scored."""
+    start = time.monotonic()
+    before = scored(metrics_url) if metrics_url else 0
+    sent = 0
+    futures = []
+    with ThreadPoolExecutor(concurrency) as executor:
+        for update in updates:
+            if rate:
+                time.sleep(max(0.0, start + sent / rate - time.monotonic()))
+            futures.append(executor.submit(post, url, update))
+            sent += 1
+    accepted = sum(future.result() for future in futures)
+    elapsed = time.monotonic() - start
+    print("Posted {:,} updates in {:.2f} s, {:.1f} updates/s, {:,} rejected".format(sent, elapsed, sent / elapsed, sent - accepted))
+    if metrics_url:
+        # Wait until the bot has scored every accepted message
+        while scored(metrics_url) - before < accepted:
+            time.sleep(0.1)
+        elapsed = time.monotonic() - start
+        print("Scored {:,} messages in {:.2f} s, {:.1f} msg/s end to end".format(accepted, elapsed, accepted / elapsed))
+
+
+def raid(messages: int, chats: int, users: int, direct: bool = False, seed: int = 42):
+    """Applies warn, delete and mute for a burst of toxic messages against a rate-limited fake Bot API.
+
+    With direct the calls are made right away like the bot used to, otherwise they go through ActionScheduler.
+    """
+    from telegram import Bot, ChatPermissions
+    from telegram.error import RetryAfter
+    from actions import ActionScheduler
+
+    server = FakeBotAPI("127.0.0.1", 0, limits=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    bot = Bot("123:fake", base_url="http://127.0.0.1:%d/bot" % server.server_address[1])
+    scheduler = None if direct else ActionScheduler(bot)
+    rng = random.Random(seed)
+    failed = Counter()
+
+    def apply(message_id, chat_id, user_id):
+        until = int(time.time()) + 600
+        if scheduler:
+            scheduler.warn(chat_id, user_id, message_id, "user%d This is too toxic!" % user_id)
+            scheduler.delete(chat_id, message_id)
+            scheduler.mute(chat_id, user_id, until)
+            return
+        for call in [lambda: bot.send_message(chat_id, "user%d This is too toxic!" % user_id, reply_to_message_id=message_id),
+                     lambda: bot.delete_message(chat_id, message_id),
+                     lambda: bot.restrict_chat_member(chat_id, user_id, ChatPermissions(can_send_messages=False), until_date=until)]:
+            try:
+                call()
+            except RetryAfter:
+                failed["dropped"] += 1
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(8) as executor:
+        for message_id in range(1, messages + 1):
+            executor.submit(apply, message_id, -1000000000000 - rng.randrange(chats), 100 + rng.randrange(users))
+    if scheduler:
+        scheduler.stop()
+    elapsed = time.monotonic() - start
+    calls = dict(server.calls)
+    print("{} {:,} toxic messages in {:.1f} s: {:,} calls answered 429, {:,} actions dropped".format(
+        "Direct" if direct else "Scheduled", messages, elapsed, calls.pop("429", 0), failed["dropped"]))
+    print(calls)
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Local stand-ins for Telegram to measure the bot without the real Bot API")
+    commands = parser.add_subparsers(dest="command", required=True)
+    api = commands.add_parser("api", help="run a fake Bot API server")
+    api.add_argument("--host", default="127.0.0.1")
+    api.add_argument("--port", type=int, default=8081)
+    api.add_argument("--latency", type=float, default=0.0, help="seconds added to every call")
+    api.add_argument("--limits", action="store_true", help="answer calls over Telegram flood limits with 429")
+    record = commands.add_parser("generate", help="write synthetic group message updates as JSONL")
+    record.add_argument("output")
+    record.add_argument("--count", type=int, default=10000)
+    record.add_argument("--chats", type=int, default=100)
+    record.add_argument("--users", type=int, default=1000)
+    player = commands.add_parser("replay", help="POST recorded updates (JSONL) to the webhook")
+    player.add_argument("updates")
+    player.add_argument("url")
+    player.add_argument("--rate", type=float, default=0.0, help="updates per second, 0 is as fast as possible")
+    player.add_argument("--concurrency", type=int, default=8)
+    player.add_argument("--metrics", help="bot metrics URL to measure end-to-end throughput")
+    flood = commands.add_parser("raid", help="moderate a burst of toxic messages against a rate-limited fake Bot API")
+    flood.add_argument("--messages", type=int, default=300)
+    flood.add_argument("--chats", type=int, default=3)
+    flood.add_argument("--users", type=int, default=20)
+    flood.add_argument("--direct", action="store_true", help="call the API right away instead of through ActionScheduler")
+    args = parser.parse_args()
+
+    if args.command == "api":
+        server = FakeBotAPI(args.host, args.port, args.latency, args.limits)
+        print("Fake Bot API on http://%s:%d/bot" % (args.host, args.port))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            print(dict(server.calls))
+    elif args.command == "generate":
+        with open(args.output, "w") as file:
+            for update in generate(args.count, args.chats, args.users):
+                file.write(json.dumps(update, ensure_ascii=False) + "\n")
+    elif args.command == "raid":
+        raid(args.messages, args.chats, args.users, args.direct)
+    else:
+        with open(args.updates) as file:
+            replay((json.loads(line) for line in file if line.strip()), args.url, args.rate, args.concurrency, args.metrics)
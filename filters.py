@@ -1,8 +1,9 @@
-from telegram import Update, Chat, ChatMember
+from telegram import Update, Chat
+
+import members
 
 def AdminFilter(update: Update): # Only for use with FilteredConversationHandler
     chat = update.effective_chat
     if chat.type not in [Chat.GROUP, Chat.SUPERGROUP]:
         return True
-    member = chat.get_member(update.effective_user.id)
-    return member.status in [ChatMember.CREATOR, ChatMember.ADMINISTRATOR]
+    return members.is_admin(chat, update.effective_user.id)
@@ -50,10 +50,15 @@ class FilteredConversationHandler(ConversationHandler):
             run_async,
         )
     def check_update(self, update: object) -> CheckUpdateType:
+        # Filters may be expensive (AdminFilter calls getChatMember), so they only run
+        # for updates the conversation would handle, not for every message in the chat
+        check = super().check_update(update)
+        if check is None:
+            return None
         for f in self.filters:
             if not f(update):
                 return None
-        return super().check_update(update)
+        return check
 
 def ReadHandler(process: Callable[[Update, CallbackContext], Any], gen_query=lambda update, context: "", pattern=None, choices=[], ret=None):
     def callback(update: Update, context: CallbackContext):
@@ -1,4 +1,4 @@
-from typing import Dict, List
+from typing import Dict, List, Tuple
 import traceback
 import json
 import re
@@ -6,9 +6,11 @@ import functools
 import asyncio
 import concurrent
 import time
+import signal
+import threading
 from pytimeparse.timeparse import timeparse
 import logging
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update, Chat, ChatMember, ChatPermissions
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update, Chat, ChatMember
 from telegram.ext import (
     Updater,
     CommandHandler,
@@ -16,13 +18,23 @@ from telegram.ext import (
     ConversationHandler,
     CallbackContext,
     MessageHandler,
-    PicklePersistence,
+    ChatMemberHandler,
+    TypeHandler,
 )
 from telegram.ext.filters import Filters
 
 import checker
 from handlers import FilteredConversationHandler, ReadHandler
+from pipeline import Pipeline
+from actions import ActionScheduler
+from prefilter import Prefilter
+from persistence import SQLitePersistence
+from strikes import Strikes, total_stats
+from webhook import WebhookServer
+from shard import ShardRouter
 import filters
+import members
+import metrics
 
 # Enable logging
 logging.basicConfig(
@@ -33,11 +45,23 @@ logger = logging.getLogger(__name__)
 
 help_string = """/start - start conversation with bot
 /help - print help
-/configure - start configuration wizzard"""
+/configure - start configuration wizzard
+/stats - show memory used by strike records of this chat (admins only)"""
 
 def print_help(update: Update, context: CallbackContext) -> None:
     update.message.reply_text(help_string, disable_notification=True)
 
+def print_stats(update: Update, context: CallbackContext) -> None:
+    chat = update.effective_chat
+    if chat.type not in [Chat.GROUP, Chat.SUPERGROUP]:
+        update.message.reply_text("Stats are kept only for groups and supergroups.", disable_notification=True)
+        return
+    if not members.is_admin(chat, update.effective_user.id):
+        update.message.reply_text("Only administrator can see stats.", disable_notification=True)
+        return
+    stats = context.chat_data.get("strikes", Strikes()).stats()
+    update.message.reply_text("Users with active strikes: {}\nMemory used by strike records: {:,} bytes".format(stats["users"], stats["bytes"]), disable_notification=True)
+
 def start(update: Update, context: CallbackContext) -> None:
     if update.effective_chat.type not in [Chat.GROUP, Chat.SUPERGROUP]:
         update.message.reply_text("Hello, I'm Detoxification bot. I can help you to deal with tox in your chat. You should add me there first.", disable_notification=True)
@@ -70,38 +94,76 @@ class Rule():
 default_rules = [Rule({"warn": "This is too toxic!"})]
 default_tox_level = 0.4
 
+max_batch_size = 32
+max_batch_wait = 0.005
+# Number of forked scoring processes, 0 scores in the bot process itself
+scoring_processes = 0
+# "torch", "quantized" (int8, cached in ./model/quantized.pt) or "onnx" (requires model exported with export_onnx.py)
+checker_backend = "torch"
+# Obviously clean or obscene messages are decided by prefilter.py without running the model.
+# Enable after checking its agreement with the model: python prefilter.py --data test.csv
+use_prefilter = False
+# Limits of the message pipeline: messages being scored or waiting for moderation actions, and threads for the actions
+max_scoring = 1024
+action_workers = 8
+# Moderation calls are sent by scheduler_workers threads, at most chat_message_rate messages per second to a chat
+# and global_call_rate calls per second overall, which keeps the bot under Telegram flood limits
+scheduler_workers = 8
+chat_message_rate = 17 / 60
+global_call_rate = 25
+# Telegram delivers updates to webhook_url + webhook_path when webhook_url is set, otherwise the bot polls
+webhook_url = None
+webhook_listen = "127.0.0.1"
+webhook_port = 8443
+webhook_path = "/telegram"
+webhook_workers = 16
+webhook_max_pending = 10000
+# Bot API server, None is the official one. fake_telegram.py provides a local stand-in for load tests
+bot_api_url = None
+# Prometheus metrics are served on http://127.0.0.1:<metrics_port>/metrics, None disables them.
+# Shard workers use the following ports.
+metrics_port = 9108
+# Number of bot worker processes chats are spread over, 0 runs everything in this process.
+# SIGUSR1 adds a worker and SIGUSR2 removes one while running.
+shards = 0
+
+pipeline = None
+scheduler = None
+
 def process_msg(update: Update, context: CallbackContext) -> None:
     message = update.message if update.message else update.edited_message
-    score = checker.score(message.text)
     logger.info("Processing message")
+    data = context.chat_data
+    tox_level = data["tox_level"] if "tox_level" in data else default_tox_level
+    pipeline.submit(update, context, message.text, tox_level)
+
+def apply_rules(update: Update, context: CallbackContext, score: float) -> None:
+    message = update.message if update.message else update.edited_message
     chat = update.effective_chat
-    member = chat.get_member(update.effective_user.id)
+    with metrics.action_seconds.time(action="get_member"):
+        member = members.get_member(chat, update.effective_user.id)
     is_admin = member.status in [ChatMember.CREATOR, ChatMember.ADMINISTRATOR]
     data = context.chat_data
     rule_name = "rules_" + ("admin" if is_admin else "user")
     rules = data[rule_name] if rule_name in data else default_rules
-    state = data[member.user.id] if member.user.id in data else (0, 0) # time and current rule to apply index
-    last_time_applied, current_rule = state
     if len(rules) == 0:
         return
+    strikes = data.setdefault("strikes", Strikes())
+    current_rule = min(strikes.current(member.user.id), len(rules) - 1)
     rule = rules[current_rule]
-    #score = await score
-    tox_level = data["tox_level"] if "tox_level" in data else default_tox_level
-    if score < tox_level:
-        return
 
-    if time.time() - last_time_applied > rule.reset_time:
-        current_rule = 0
+    # Telegram calls are queued and sent by the scheduler within flood limits, strikes are counted right away
+    until = int(time.time())
     if rule.warn != "":
-        message.reply_text(((member.user.username + " ") if rule.delete else "") + rule.warn.replace("{score}", str(int(score * 100))))
+        scheduler.warn(chat.id, member.user.id, message.message_id, ((member.user.username + " ") if rule.delete else "") + rule.warn.replace("{score}", str(int(score * 100))))
     if rule.delete:
-        message.delete()
+        scheduler.delete(chat.id, message.message_id)
     if rule.mute_time:
-        chat.restrict_member(member.user.id, ChatPermissions(can_send_messages=False), until_date=int(time.time()) + rule.mute_time)
+        scheduler.mute(chat.id, member.user.id, until + rule.mute_time)
     if rule.ban_time:
-        chat.ban_member(member, until_date=time.time() + rule.ban_time)
-    current_rule = min(current_rule + 1, len(rules) - 1)
-    data[member.user.id] = (time.time(), current_rule)
+        scheduler.ban(chat.id, member.user.id, until + rule.ban_time)
+    next_rule = min(current_rule + 1, len(rules) - 1)
+    strikes.record(member.user.id, next_rule, rules[next_rule].reset_time)
 
 class State:
     (CONFIG,
@@ -115,8 +177,7 @@ def configure(update: Update, context: CallbackContext, quote=None, first=True):
         return ConversationHandler.END
 
     chat = update.effective_chat
-    member = chat.get_member(update.effective_user.id)
-    is_admin = member.status in [ChatMember.CREATOR, ChatMember.ADMINISTRATOR]
+    is_admin = members.is_admin(chat, update.effective_user.id)
 
     if not is_admin:
         update.message.reply_text("Only administrator can configure bot.")
@@ -267,20 +328,42 @@ def empty_handler(update: Update, context: CallbackContext):
     if update.callback_query:
         update.callback_query.answer()
 
-def main() -> None:
-    """Run the bot."""
-    
-    checker.load("./model")
-    persistence = PicklePersistence("state")
+def create_bot(metrics_port=None, background=True) -> Tuple[Updater, Pipeline, ActionScheduler]:
+    global pipeline, scheduler
+
+    if use_prefilter:
+        checker.prefilter = Prefilter()
+    # The model loads in the background while the bot connects to Telegram, messages wait for it in the pipeline.
+    # Scoring processes are forked before any other thread starts.
+    checker.load("./model", max_batch_size=max_batch_size, max_wait=max_batch_wait, processes=scoring_processes,
+        backend=checker_backend, background=background and scoring_processes == 0)
+    # An old "state" pickle can be imported with: python persistence.py state state.sqlite
+    persistence = SQLitePersistence("state.sqlite")
     # Create the Updater and pass it your bot's token.
-    updater = Updater("<Your token>", persistence=persistence)
+    updater = Updater("<Your token>", persistence=persistence, base_url=bot_api_url)
+    scheduler = ActionScheduler(updater.bot, scheduler_workers, chat_rate=chat_message_rate, global_rate=global_call_rate)
+    pipeline = Pipeline(checker.submit, apply_rules, max_scoring, action_workers)
+
+    if metrics_port:
+        metrics.Gauge("checker_cache_hit_rate", "Share of messages scored from the verdict cache", lambda: checker.cache.stats()["hit_rate"])
+        metrics.Gauge("checker_cache_size", "Messages in the verdict cache", lambda: len(checker.cache))
+        metrics.Gauge("bot_member_cache_hit_rate", "Share of member lookups answered from cache", lambda: members.cache.stats()["hit_rate"])
+        metrics.Gauge("checker_queue_depth", "Messages waiting to be batched", lambda: checker.batcher.queue.qsize())
+        metrics.Gauge("bot_action_queue_depth", "Flagged messages waiting for actions", pipeline.queue_depth)
+        metrics.Gauge("bot_strike_users", "Users with active strikes in loaded chats", lambda: total_stats(updater.dispatcher.chat_data)["users"])
+        metrics.Gauge("bot_strike_bytes", "Approximate memory held by strike records", lambda: total_stats(updater.dispatcher.chat_data)["bytes"])
+        metrics.Gauge("bot_scheduler_pending_chats", "Chats with moderation calls waiting to be sent", scheduler.queue_depth)
+        metrics.serve(metrics_port)
 
     # Get the dispatcher to register handlers
     dispatcher = updater.dispatcher
-    #dispatcher.start()
+
+    # Drop cached member status as soon as it changes
+    dispatcher.add_handler(ChatMemberHandler(members.invalidate, ChatMemberHandler.ANY_CHAT_MEMBER), group=-1)
 
     dispatcher.add_handler(CommandHandler('start', start, run_async=True))
     dispatcher.add_handler(CommandHandler('help', print_help, run_async=True))
+    dispatcher.add_handler(CommandHandler('stats', print_stats, run_async=True))
 
     config_handler = FilteredConversationHandler(
         entry_points=[CommandHandler("configure", configure)],
@@ -327,9 +410,47 @@ def main() -> None:
 
     dispatcher.add_handler(CallbackQueryHandler(empty_handler))
 
-    updater.start_polling()
+    return updater, pipeline, scheduler
 
-    updater.idle()
+def receive_updates(updater: Updater) -> None:
+    if webhook_url:
+        run_webhook(updater)
+    else:
+        # chat_member updates are only delivered when requested explicitly
+        updater.start_polling(allowed_updates=Update.ALL_TYPES)
+        updater.idle()
+
+def main() -> None:
+    """Run the bot."""
+    if shards:
+        router = ShardRouter(create_bot, shards, metrics_port)
+        updater = Updater("<Your token>", base_url=bot_api_url)
+        updater.dispatcher.add_handler(TypeHandler(Update, router.route))
+        receive_updates(updater)
+        router.stop()
+        return
+
+    updater, _, _ = create_bot(metrics_port)
+    receive_updates(updater)
+    pipeline.stop()
+    scheduler.stop()
+    updater.persistence.flush()
+
+def run_webhook(updater: Updater) -> None:
+    dispatcher = updater.dispatcher
+    threading.Thread(target=dispatcher.start, name="Dispatcher", daemon=True).start()
+    server = WebhookServer(dispatcher, webhook_listen, webhook_port, webhook_path, webhook_workers, webhook_max_pending)
+    server.start()
+    updater.bot.set_webhook(webhook_url + webhook_path, max_connections=webhook_workers, allowed_updates=Update.ALL_TYPES)
+
+    stopped = threading.Event()
+    for signum in [signal.SIGINT, signal.SIGTERM]:
+        signal.signal(signum, lambda signum, frame: stopped.set())
+    stopped.wait()
+
+    server.shutdown()
+    dispatcher.stop()
+    dispatcher.update_persistence()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,26 @@
+from telegram import Update, Chat, ChatMember
+from telegram.ext import CallbackContext
+
+from cache import TTLCache
+
+# Chat member lookups keyed by (chat_id, user_id)
+cache = TTLCache(maxsize=100000, ttl=10 * 60)
+
+
+def get_member(chat: Chat, user_id: int) -> ChatMember:
+    key = (chat.id, user_id)
+    member = cache.get(key)
+    if member is None:
+        member = chat.get_member(user_id)
+        cache.put(key, member)
+    return member
+
+
+def is_admin(chat: Chat, user_id: int) -> bool:
+    return get_member(chat, user_id).status in [ChatMember.CREATOR, ChatMember.ADMINISTRATOR]
+
+
+def invalidate(update: Update, context: CallbackContext) -> None:
+    # Handler for chat_member and my_chat_member updates
+    changed = update.chat_member or update.my_chat_member
+    cache.invalidate((changed.chat.id, changed.new_chat_member.user.id))
@@ -0,0 +1,143 @@
+from typing import Callable, List
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import contextlib
+import threading
+import logging
+import bisect
+import time
+
+logger = logging.getLogger(__name__)
+
+registry = []
+
+
+def format_labels(labels: tuple, extra: str = "") -> str:
+    parts = ['%s="%s"' % (key, str(value).replace('"', '\\"')) for key, value in labels]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Counter():
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+        self.values = defaultdict(float)
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] += amount
+
+    def collect(self) -> List[str]:
+        lines = ["# HELP %s %s" % (self.name, self.documentation), "# TYPE %s counter" % self.name]
+        with self.lock:
+            values = list(self.values.items())
+        for labels, value in values:
+            lines.append("%s%s %s" % (self.name, format_labels(labels), value))
+        return lines
+
+
+class Histogram():
+    buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, name: str, documentation: str, buckets: tuple = None):
+        self.name = name
+        self.documentation = documentation
+        if buckets:
+            self.buckets = buckets
+        # Labels to [count per bucket..., +Inf count, sum]
+        self.values = dict()
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def collect(self) -> List[str]:
+        lines = ["# HELP %s %s" % (self.name, self.documentation), "# TYPE %s histogram" % self.name]
+        with self.lock:
+            values = [(labels, list(counts)) for labels, counts in self.values.items()]
+        for labels, counts in values:
+            total = 0
+            for bound, count in zip(list(self.buckets) + ["+Inf"], counts):
+                total += count
+                lines.append("%s_bucket%s %d" % (self.name, format_labels(labels, 'le="%s"' % bound), total))
+            lines.append("%s_sum%s %s" % (self.name, format_labels(labels), counts[-1]))
+            lines.append("%s_count%s %d" % (self.name, format_labels(labels), total))
+        return lines
+
+
+class Gauge():
+    """Value computed only when metrics are scraped."""
+
+    def __init__(self, name: str, documentation: str, function: Callable[[], float]):
+        self.name = name
+        self.documentation = documentation
+        self.function = function
+        registry.append(self)
+
+    def collect(self) -> List[str]:
+        try:
+            value = self.function()
+        except Exception:
+            logger.exception("Failed to collect %s", self.name)
+            return []
+        return ["# HELP %s %s" % (self.name, self.documentation), "# TYPE %s gauge" % self.name, "%s %s" % (self.name, value)]
+
+
+def render() -> str:
+    lines = []
+    for metric in registry:
+        lines += metric.collect()
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port: int, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="Metrics", daemon=True).start()
+    logger.info("Serving metrics on http://%s:%d/metrics", host, port)
+    return server
+
+
+tokenize_seconds = Histogram("checker_tokenize_seconds", "Time spent tokenizing a batch of messages")
+model_seconds = Histogram("checker_model_seconds", "Time spent in the model forward pass for a batch")
+batch_size = Histogram("checker_batch_size", "Messages per forward pass", (1, 2, 4, 8, 16, 32, 64, 128))
+action_seconds = Histogram("bot_action_seconds", "Time spent in Telegram API calls made while applying rules")
+persistence_seconds = Histogram("bot_persistence_write_seconds", "Time spent writing buffered persistence updates")
+messages = Counter("bot_messages_total", "Messages by outcome: scored, flagged, deleted, muted, banned")
+prefilter = Counter("checker_prefilter_total", "Messages decided by the lexical prefilter without the model")
@@ -0,0 +1,28 @@
+from typing import Iterable, List
+import re
+
+# Applied in this order, each one sees the output of the previous one
+patterns = [
+    (re.compile(r"<[^>]*>"), " "),
+    (re.compile(r"^\[id\d*|.*\],*\s*"), ""),
+    (re.compile(r"(&quot;)|(&lt;)|(&gt;)|(&amp;)|(&apos;)"), " "),
+    (re.compile(r"https?://(www\.)?[-a-zA-Z0-9@:%._+~#=]{2,256}\.[a-z]{2,6}\b([-a-zA-Z0-9@:%_+.~#?&/=]*)"), " "),
+    (re.compile(r"\[[^\[\]]+\|([^\[\]]+)\]"), r"\1"),
+    (re.compile(r"(&#\d+;)"), " "),
+]
+# Punctuation and line breaks become spaces
+table = str.maketrans({char: " " for char in ".,!?;:)(_#*=^/`@«»©…“•—<>[]\"'+%|&\n"})
+spaces = re.compile(r"\s\s+")
+
+
+def normalize(sentence: str) -> str:
+    for pattern, replacement in patterns:
+        sentence = pattern.sub(replacement, sentence)
+    sentence = sentence.translate(table)
+    sentence = sentence.replace("--", " ")
+    sentence = spaces.sub(" ", sentence)
+    return sentence.lower()
+
+
+def normalize_batch(sentences: Iterable[str]) -> List[str]:
+    return [normalize(sentence) for sentence in sentences]
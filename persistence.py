@@ -0,0 +1,226 @@
+from typing import Any, DefaultDict, Dict, Optional, Tuple
+from collections import defaultdict
+import threading
+import pickle
+import sqlite3
+import logging
+import json
+import time
+import sys
+
+from telegram.ext import BasePersistence
+from telegram.ext.utils.types import ConversationDict
+
+from strikes import Strike, Strikes
+import metrics
+
+logger = logging.getLogger(__name__)
+
+schema = """
+CREATE TABLE IF NOT EXISTS chat_settings (chat_id INTEGER, key TEXT, value BLOB, PRIMARY KEY (chat_id, key));
+CREATE TABLE IF NOT EXISTS strikes (chat_id INTEGER, user_id INTEGER, expires REAL, rule INTEGER, PRIMARY KEY (chat_id, user_id));
+CREATE TABLE IF NOT EXISTS user_data (user_id INTEGER PRIMARY KEY, value BLOB);
+CREATE TABLE IF NOT EXISTS bot_data (id INTEGER PRIMARY KEY, value BLOB);
+CREATE TABLE IF NOT EXISTS conversations (name TEXT, key TEXT, state BLOB, PRIMARY KEY (name, key));
+"""
+
+
+class LazyData(defaultdict):
+    """Per chat or per user data that is read from the database on first access."""
+
+    def __init__(self, load):
+        super().__init__(dict)
+        self.load = load
+
+    def __missing__(self, key):
+        value = self.load(key)
+        self[key] = value
+        return value
+
+
+def migrate_strikes(data: Dict) -> Dict:
+    """Converts (time, rule index) tuples stored under user ids into a Strikes record."""
+    data = dict(data)
+    strikes = Strikes()
+    rules = data.get("rules_user")
+    for user_id in [key for key in data if isinstance(key, int)]:
+        last_time_applied, rule = data.pop(user_id)
+        reset_time = rules[rule].reset_time if rules and rule < len(rules) else 0
+        if rule > 0 and last_time_applied + reset_time > time.time():
+            strikes.records[user_id] = Strike(last_time_applied + reset_time, rule)
+    if strikes.records:
+        data["strikes"] = strikes
+    return data
+
+
+class SQLitePersistence(BasePersistence):
+    """Stores chat settings, per-user strike state and conversations as separate SQLite rows.
+
+    Only changed rows are written. Writes are buffered and committed in one
+    transaction every flush_interval seconds and on flush, through a connection of
+    their own so that reads on the dispatcher thread don't wait for them. The bot
+    keeps nothing in user_data and bot_data, so they are not stored.
+    """
+
+    def __init__(self, filename: str, flush_interval: float = 5.0):
+        super().__init__(store_user_data=False, store_chat_data=True, store_bot_data=False)
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript(schema)
+        self.writer = sqlite3.connect(filename, check_same_thread=False)
+        self.lock = threading.RLock()
+        self.write_lock = threading.Lock()
+        # Last written pickled value of each chat data key, used to find changed rows
+        self.snapshots = dict()
+        # SQL statement and parameters by row, latest write wins
+        self.pending = dict()
+        self.stopped = threading.Event()
+        self.flush_interval = flush_interval
+        self.thread = threading.Thread(target=self.run, name="SQLitePersistence", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.flush_interval):
+            try:
+                self.write()
+            except Exception:
+                logger.exception("Failed to write persistence")
+
+    def write(self):
+        with self.write_lock:
+            with self.lock:
+                pending, self.pending = self.pending, dict()
+            if not pending:
+                return
+            with self.writer, metrics.persistence_seconds.time():
+                for statement, parameters in pending.values():
+                    self.writer.execute(statement, parameters)
+
+    # Stored data never holds Bot instances, so it is not copied looking for them.
+    # Copying lazily loaded data would also load every row.
+    def insert_bot(self, obj: Any) -> Any:
+        return obj
+
+    def replace_bot(self, obj: Any) -> Any:
+        return obj
+
+    def load_chat(self, chat_id: int) -> Dict:
+        data = dict()
+        snapshot = dict()
+        with self.lock:
+            for key, value in self.connection.execute("SELECT key, value FROM chat_settings WHERE chat_id = ?", (chat_id,)):
+                data[key] = pickle.loads(value)
+                snapshot[key] = value
+            strikes = Strikes()
+            for user_id, expires, rule in self.connection.execute("SELECT user_id, expires, rule FROM strikes WHERE chat_id = ?", (chat_id,)):
+                strikes.records[user_id] = Strike(expires, rule)
+                snapshot[user_id] = (expires, rule)
+            if strikes.records:
+                data["strikes"] = strikes
+            self.snapshots[chat_id] = snapshot
+        return data
+
+    def forget(self, chat_id: int):
+        """Drops what is known about a chat that is now handled by another process."""
+        with self.lock:
+            self.snapshots.pop(chat_id, None)
+
+    def load_user(self, user_id: int) -> Dict:
+        with self.lock:
+            row = self.connection.execute("SELECT value FROM user_data WHERE user_id = ?", (user_id,)).fetchone()
+        return pickle.loads(row[0]) if row else dict()
+
+    def get_chat_data(self) -> DefaultDict[int, Dict[Any, Any]]:
+        return LazyData(self.load_chat)
+
+    def get_user_data(self) -> DefaultDict[int, Dict[Any, Any]]:
+        return LazyData(self.load_user)
+
+    def get_bot_data(self) -> Dict[Any, Any]:
+        with self.lock:
+            row = self.connection.execute("SELECT value FROM bot_data WHERE id = 0").fetchone()
+        return pickle.loads(row[0]) if row else dict()
+
+    def get_conversations(self, name: str) -> ConversationDict:
+        with self.lock:
+            rows = self.connection.execute("SELECT key, state FROM conversations WHERE name = ?", (name,)).fetchall()
+        return {tuple(json.loads(key)): pickle.loads(state) for key, state in rows}
+
+    def get_callback_data(self) -> Optional[Any]:
+        return None
+
+    def update_chat_data(self, chat_id: int, data: Dict) -> None:
+        with self.lock:
+            snapshot = self.snapshots.setdefault(chat_id, dict())
+            # Settings are keyed by name, strike records by user id
+            rows = dict()
+            for key, value in data.items():
+                if isinstance(value, Strikes):
+                    for user_id, strike in list(value.records.items()):
+                        rows[user_id] = (strike.expires, strike.rule)
+                else:
+                    rows[key] = pickle.dumps(value)
+            for key, row in rows.items():
+                if snapshot.get(key) == row:
+                    continue
+                snapshot[key] = row
+                if isinstance(key, int):
+                    self.pending[("strikes", chat_id, key)] = ("INSERT OR REPLACE INTO strikes VALUES (?, ?, ?, ?)", (chat_id, key, row[0], row[1]))
+                else:
+                    self.pending[("chat_settings", chat_id, key)] = ("INSERT OR REPLACE INTO chat_settings VALUES (?, ?, ?)", (chat_id, key, row))
+            for key in [key for key in snapshot if key not in rows]:
+                del snapshot[key]
+                if isinstance(key, int):
+                    self.pending[("strikes", chat_id, key)] = ("DELETE FROM strikes WHERE chat_id = ? AND user_id = ?", (chat_id, key))
+                else:
+                    self.pending[("chat_settings", chat_id, key)] = ("DELETE FROM chat_settings WHERE chat_id = ? AND key = ?", (chat_id, key))
+
+    def update_user_data(self, user_id: int, data: Dict) -> None:
+        with self.lock:
+            self.pending[("user_data", user_id)] = ("INSERT OR REPLACE INTO user_data VALUES (?, ?)", (user_id, pickle.dumps(data)))
+
+    def update_bot_data(self, data: Dict) -> None:
+        with self.lock:
+            self.pending[("bot_data",)] = ("INSERT OR REPLACE INTO bot_data VALUES (0, ?)", (pickle.dumps(data),))
+
+    def update_conversation(self, name: str, key: Tuple[int, ...], new_state: Optional[object]) -> None:
+        with self.lock:
+            if new_state is None:
+                self.pending[("conversations", name, key)] = ("DELETE FROM conversations WHERE name = ? AND key = ?", (name, json.dumps(key)))
+            else:
+                self.pending[("conversations", name, key)] = ("INSERT OR REPLACE INTO conversations VALUES (?, ?, ?)", (name, json.dumps(key), pickle.dumps(new_state)))
+
+    def update_callback_data(self, data: Any) -> None:
+        pass
+
+    def flush(self) -> None:
+        self.stopped.set()
+        self.thread.join()
+        self.write()
+
+    def migrate(self, filename: str) -> None:
+        """Copies everything from a PicklePersistence(filename) file."""
+        with open(filename, "rb") as file:
+            data = pickle.load(file)
+        for chat_id, chat_data in data.get("chat_data", dict()).items():
+            self.update_chat_data(chat_id, migrate_strikes(chat_data))
+        for user_id, user_data in data.get("user_data", dict()).items():
+            self.update_user_data(user_id, user_data)
+        if data.get("bot_data"):
+            self.update_bot_data(data["bot_data"])
+        for name, conversations in data.get("conversations", dict()).items():
+            for key, state in conversations.items():
+                self.update_conversation(name, key, state)
+        self.write()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print("Usage: python persistence.py <pickle state file> <sqlite file>")
+        sys.exit(1)
+    # Rules are pickled as main.Rule objects
+    import main
+    sys.modules["__main__"].Rule = main.Rule
+    persistence = SQLitePersistence(sys.argv[2])
+    persistence.migrate(sys.argv[1])
+    persistence.flush()
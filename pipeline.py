@@ -0,0 +1,114 @@
+from typing import Callable
+from concurrent.futures import Future
+from queue import Queue
+import threading
+import logging
+
+from telegram import Update
+from telegram.ext import CallbackContext
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class Pipeline():
+    """Scores messages asynchronously and applies actions only to the ones over the threshold.
+
+    At most max_scoring messages are being scored or waiting for an action worker at
+    once, submit blocks the caller when that limit is reached. Toxic messages go to one
+    of action_workers queues chosen by (chat_id, user_id), so actions for the same user
+    run in order and never concurrently with each other. A flagged message keeps its
+    slot until a worker takes it, so the queues never block the scoring threads and
+    slow actions hold up the submitting thread instead.
+    """
+
+    def __init__(
+        self,
+        score: Callable[[str], Future],
+        act: Callable[[Update, CallbackContext, float], None],
+        max_scoring: int = 1024,
+        action_workers: int = 8,
+    ):
+        self.score = score
+        self.act = act
+        self.scoring = threading.BoundedSemaphore(max_scoring)
+        # Messages submitted but not yet scored or taken by an action worker
+        self.in_flight = 0
+        self.changed = threading.Condition()
+        self.queues = [Queue() for _ in range(action_workers)]
+        self.threads = [threading.Thread(target=self.run, args=(queue,), name="Pipeline-%d" % i, daemon=True) for i, queue in enumerate(self.queues)]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, update: Update, context: CallbackContext, text: str, threshold: float):
+        self.scoring.acquire()
+        with self.changed:
+            self.in_flight += 1
+        try:
+            future = self.score(text)
+        except Exception:
+            self.done()
+            raise
+        future.add_done_callback(lambda f: self.scored(update, context, f, threshold))
+
+    def done(self):
+        self.scoring.release()
+        with self.changed:
+            self.in_flight -= 1
+            self.changed.notify_all()
+
+    def scored(self, update: Update, context: CallbackContext, future: Future, threshold: float):
+        queued = False
+        try:
+            queued = self.dispatch(update, context, future, threshold)
+        finally:
+            # A queued message is released by the action worker that takes it
+            if not queued:
+                self.done()
+
+    def dispatch(self, update: Update, context: CallbackContext, future: Future, threshold: float) -> bool:
+        """Queues a flagged message for actions, returns whether it was queued."""
+        if future.exception() is not None:
+            logger.error("Failed to score message", exc_info=future.exception())
+            return False
+        score = future.result()
+        metrics.messages.inc(outcome="scored")
+        if score < threshold:
+            return False
+        metrics.messages.inc(outcome="flagged")
+        key = (update.effective_chat.id, update.effective_user.id)
+        self.queues[hash(key) % len(self.queues)].put((update, context, score))
+        return True
+
+    def drain(self):
+        """Waits until every submitted message is scored and its actions are applied."""
+        with self.changed:
+            self.changed.wait_for(lambda: self.in_flight == 0)
+        for queue in self.queues:
+            queue.join()
+
+    def queue_depth(self) -> int:
+        return sum(queue.qsize() for queue in self.queues)
+
+    def run(self, queue: Queue):
+        while True:
+            item = queue.get()
+            if item is None:
+                queue.task_done()
+                break
+            update, context, score = item
+            self.done()
+            try:
+                self.act(update, context, score)
+                context.dispatcher.update_persistence(update)
+            except Exception:
+                logger.exception("Failed to apply rules")
+            finally:
+                queue.task_done()
+
+    def stop(self):
+        for queue in self.queues:
+            queue.put(None)
+        for thread in self.threads:
+            thread.join()
@@ -0,0 +1,139 @@
+from typing import Iterable, Iterator, List, Optional, Tuple
+from collections import deque
+import argparse
+import re
+
+# Roots of Russian obscene words, matched at the start of a word or after one of the prefixes below,
+# optionally followed by a hard or soft sign (подъебал, разъебай)
+obscene_roots = [
+    "хуй", "хуе", "хуё", "хуя", "хую", "хуи", "пизд", "ебат", "ебан", "ебал", "ебаш", "ебай", "ебу", "ебл",
+    "ебо", "ебн", "еби", "бля", "муда", "мудил", "залуп", "сука", "суки", "сучк", "пидор", "пидар", "гандон",
+    "шлюх", "долбоеб", "мандав", "дрочи", "говноед",
+]
+prefixes = ["", "за", "на", "по", "от", "вы", "до", "у", "раз", "рас", "при", "с", "из", "об", "под", "пере", "недо", "не", "о"]
+# Ordinary words starting with a root, a match is ignored when the word continues with one of these
+exceptions = ["блях", "бляш", "бляп", "ебонит", "сучков", "сучкор", "сучкам", "сучки", "сучок"]
+# Messages made only of these words are clean
+clean_words = {
+    "ок", "окей", "спасибо", "спс", "пасиб", "благодарю", "да", "нет", "ага", "угу", "неа", "лол", "кек",
+    "привет", "пока", "ладно", "хорошо", "понятно", "ясно", "согласен", "согласна", "плюс", "класс", "круто",
+    "доброе", "утро", "добрый", "день", "вечер", "спокойной", "ночи", "всем", "и", "тебе", "вам", "большое",
+}
+# Latin look-alikes and digits used to get around filters
+substitutions = str.maketrans({
+    "a": "а", "b": "в", "c": "с", "e": "е", "h": "н", "k": "к", "m": "м", "o": "о", "p": "р", "t": "т",
+    "x": "х", "y": "у", "u": "и", "3": "з", "0": "о", "6": "б", "ё": "е",
+})
+letters = re.compile(r"[^\W\d_]")
+
+
+class Matcher():
+    """Aho-Corasick automaton finding all occurrences of several patterns in one pass."""
+
+    def __init__(self, patterns: Iterable[str]):
+        self.goto = [dict()]
+        self.fail = [0]
+        self.output = [[]]
+        for pattern in patterns:
+            state = 0
+            for char in pattern:
+                if char not in self.goto[state]:
+                    self.goto.append(dict())
+                    self.fail.append(0)
+                    self.output.append([])
+                    self.goto[state][char] = len(self.goto) - 1
+                state = self.goto[state][char]
+            self.output[state].append(pattern)
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, child in self.goto[state].items():
+                queue.append(child)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[child] = self.goto[fallback].get(char, 0) if self.goto[fallback].get(char, 0) != child else 0
+                self.output[child] = self.output[child] + self.output[self.fail[child]]
+
+    def find(self, text: str) -> Iterator[Tuple[int, str]]:
+        """Yields (start, pattern) for every match."""
+        state = 0
+        for i, char in enumerate(text):
+            while state and char not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(char, 0)
+            for pattern in self.output[state]:
+                yield i - len(pattern) + 1, pattern
+
+
+class Prefilter():
+    """Decides obviously clean and obviously toxic normalized messages without the model.
+
+    check returns 0.0 or 1.0 for a confident verdict and None when the model has to decide.
+    """
+
+    def __init__(self, roots: List[str] = obscene_roots, prefixes: List[str] = prefixes, clean_words: set = clean_words, max_clean_words: int = 4,
+                 exceptions: List[str] = exceptions):
+        self.matcher = Matcher(set(root.translate(substitutions) for root in roots))
+        self.prefixes = set(prefix.translate(substitutions) for prefix in prefixes)
+        self.exceptions = tuple(exception.translate(substitutions) for exception in exceptions)
+        self.clean_words = set(word.translate(substitutions) for word in clean_words)
+        self.max_clean_words = max_clean_words
+
+    def is_obscene(self, text: str) -> bool:
+        text = text.translate(substitutions)
+        for start, _ in self.matcher.find(text):
+            word_start = text.rfind(" ", 0, start) + 1
+            prefix = text[word_start:start]
+            if prefix[-1:] in ("ъ", "ь"):
+                prefix = prefix[:-1]
+            if prefix in self.prefixes and not text.startswith(self.exceptions, start):
+                return True
+        return False
+
+    def check(self, text: str) -> Optional[float]:
+        # Emoji, numbers and links only (links are removed by the normalizer)
+        if not letters.search(text):
+            return 0.0
+        words = text.split()
+        if len(words) <= self.max_clean_words and all(word.translate(substitutions) in self.clean_words for word in words):
+            return 0.0
+        if self.is_obscene(text):
+            return 1.0
+        return None
+
+
+if __name__ == '__main__':
+    import pandas as pd
+    import checker
+    from normalizer import normalize_batch
+
+    parser = argparse.ArgumentParser(description="Measure how many messages the prefilter decides and how often it agrees with the model")
+    parser.add_argument("--model", default="./model")
+    parser.add_argument("--data", default="./test.csv", help="CSV with comment and toxic columns, like train.csv")
+    parser.add_argument("--threshold", type=float, default=0.4)
+    parser.add_argument("--batch-size", type=int, default=64)
+    args = parser.parse_args()
+
+    df = pd.read_csv(args.data)
+    sentences = normalize_batch(df.comment.values)
+    labels = [int(toxic == 1) for toxic in df.toxic.values]
+    prefilter = Prefilter()
+    verdicts = [prefilter.check(sentence) for sentence in sentences]
+
+    checker.load(args.model, max_batch_size=1)
+    decided = [i for i, verdict in enumerate(verdicts) if verdict is not None]
+    scores = []
+    for i in range(0, len(decided), args.batch_size):
+        scores += checker.score_batch([sentences[j] for j in decided[i:i + args.batch_size]])
+    model_verdicts = [int(score >= args.threshold) for score in scores]
+
+    print("Messages: {:,}".format(len(sentences)))
+    print("Bypassing the model: {:.1%} (clean {:,}, toxic {:,})".format(
+        len(decided) / len(sentences), sum(verdicts[i] == 0.0 for i in decided), sum(verdicts[i] == 1.0 for i in decided)))
+    if decided:
+        print("Agreement with the model at tox_level {:.2f}: {:.1%}".format(
+            args.threshold, sum(int(verdicts[i]) == verdict for i, verdict in zip(decided, model_verdicts)) / len(decided)))
+        print("Agreement with labels: prefilter {:.1%}, model {:.1%}".format(
+            sum(int(verdicts[i]) == labels[i] for i in decided) / len(decided),
+            sum(verdict == labels[i] for i, verdict in zip(decided, model_verdicts)) / len(decided)))
@@ -0,0 +1,52 @@
+import argparse
+import os
+import time
+
+import pandas as pd
+from sklearn.metrics import precision_score, recall_score
+
+import checker
+from normalizer import normalize
+
+
+def evaluate(sentences, labels, thresholds, batch_size):
+    start = time.perf_counter()
+    scores = []
+    for i in range(0, len(sentences), batch_size):
+        scores += checker.score_batch(sentences[i:i + batch_size])
+    elapsed = time.perf_counter() - start
+    result = {"ms_per_message": elapsed / len(sentences) * 1000}
+    for threshold in thresholds:
+        predicted = [int(score >= threshold) for score in scores]
+        result[threshold] = (precision_score(labels, predicted, zero_division=0), recall_score(labels, predicted, zero_division=0))
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Build the int8 model and compare it with the fp32 one on a labeled set")
+    parser.add_argument("--model", default="./model")
+    parser.add_argument("--data", default="./test.csv", help="CSV with comment and toxic columns, like train.csv")
+    parser.add_argument("--thresholds", type=float, nargs="+", default=[0.4], help="tox_level values configured in chats")
+    parser.add_argument("--batch-size", type=int, default=32)
+    args = parser.parse_args()
+
+    df = pd.read_csv(args.data)
+    sentences = [normalize(comment) for comment in df.comment.values]
+    labels = [int(toxic == 1) for toxic in df.toxic.values]
+
+    results = dict()
+    for backend in ["torch", "quantized"]:
+        checker.load(args.model, max_batch_size=1, backend=backend)
+        results[backend] = evaluate(sentences, labels, args.thresholds, args.batch_size)
+
+    fp32, int8 = results["torch"], results["quantized"]
+    print("Messages: {}".format(len(sentences)))
+    print("Model size: fp32 {:.1f} MB, int8 {:.1f} MB".format(
+        sum(os.path.getsize(os.path.join(args.model, name)) for name in os.listdir(args.model) if name in ["pytorch_model.bin", "model.safetensors"]) / 2**20,
+        os.path.getsize(os.path.join(args.model, checker.quantized_file)) / 2**20))
+    print("Latency: fp32 {:.2f} ms/msg, int8 {:.2f} ms/msg".format(fp32["ms_per_message"], int8["ms_per_message"]))
+    for threshold in args.thresholds:
+        print("tox_level {:.2f}: precision {:.3f} -> {:.3f} ({:+.3f}), recall {:.3f} -> {:.3f} ({:+.3f})".format(
+            threshold,
+            fp32[threshold][0], int8[threshold][0], int8[threshold][0] - fp32[threshold][0],
+            fp32[threshold][1], int8[threshold][1], int8[threshold][1] - fp32[threshold][1]))
@@ -0,0 +1,172 @@
+from typing import Iterator, Tuple
+from collections import deque
+from concurrent.futures import Future
+import argparse
+import itertools
+import json
+import csv
+import sys
+import os
+import time
+
+import checker
+from normalizer import normalize_batch
+
+
+def read_texts(path: str, column: str) -> Iterator[str]:
+    with open(path, newline="", encoding="utf-8") as file:
+        if path.endswith(".csv"):
+            for row in csv.DictReader(file):
+                yield row[column]
+        else:
+            # One message per line, like the result file of parser/parse.py
+            for line in file:
+                yield line.rstrip("\n")
+
+
+header = ["text", "score", "toxic"]
+
+
+def truncate_partial(path: str):
+    # A line cut off by an interruption is dropped and scored again
+    with open(path, "rb+") as file:
+        end = file.seek(0, os.SEEK_END)
+        position = end
+        while position > 0:
+            step = min(4096, position)
+            file.seek(position - step)
+            chunk = file.read(step)
+            newline = chunk.rfind(b"\n")
+            if newline != -1:
+                position = position - step + newline + 1
+                break
+            position -= step
+        if position != end:
+            file.truncate(position)
+
+
+def truncate_partial_csv(path: str) -> Tuple[int, bool]:
+    """Drops a CSV record cut off by an interruption, returns the number of records left and whether the first is the header.
+
+    Records may span several lines inside quotes, so the file is cut after the last record
+    csv.reader parsed completely rather than after the last newline. A file ending inside
+    quotes is an error in strict mode instead of a record.
+    """
+    end = 0
+    records = 0
+    has_header = False
+    with open(path, "rb+") as file:
+        position = 0
+        terminated = False
+
+        def lines():
+            nonlocal position, terminated
+            for line in file:
+                position += len(line)
+                terminated = line.endswith(b"\n")
+                yield line.decode("utf-8")
+
+        try:
+            for row in csv.reader(lines(), strict=True):
+                # csv.writer ends every record with a line break, a record without one was cut off
+                if not terminated:
+                    break
+                if records == 0 and row == header:
+                    has_header = True
+                records += 1
+                end = position
+        except (csv.Error, UnicodeDecodeError):
+            pass
+        file.seek(0, os.SEEK_END)
+        if file.tell() != end:
+            file.truncate(end)
+    return records, has_header
+
+
+def count_done(path: str, output_format: str) -> Tuple[int, bool]:
+    """Returns the number of messages already in the output and whether it has a header."""
+    if not os.path.exists(path):
+        return 0, False
+    if output_format == "csv":
+        records, has_header = truncate_partial_csv(path)
+        return records - has_header, has_header
+    truncate_partial(path)
+    with open(path, newline="", encoding="utf-8") as file:
+        return sum(1 for _ in file), False
+
+
+def batches(texts: Iterator[str], size: int) -> Iterator[list]:
+    while True:
+        batch = list(itertools.islice(texts, size))
+        if not batch:
+            break
+        yield batch
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Score every message of a text or CSV file with the toxicity model")
+    parser.add_argument("input", help="text file with one message per line or CSV file")
+    parser.add_argument("output", help="output file, appended to when resuming")
+    parser.add_argument("--format", choices=["jsonl", "csv"], default="jsonl")
+    parser.add_argument("--column", default="comment", help="CSV column holding the message text")
+    parser.add_argument("--model", default="./model")
+    parser.add_argument("--backend", default="torch")
+    parser.add_argument("--threshold", type=float, default=0.4)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--processes", type=int, default=os.cpu_count())
+    parser.add_argument("--report-interval", type=float, default=10)
+    args = parser.parse_args()
+
+    checker.load(args.model, max_batch_size=1, processes=args.processes, backend=args.backend)
+
+    # Messages already in the output are skipped, so an interrupted run continues where it stopped
+    done, has_header = count_done(args.output, args.format)
+    texts = itertools.islice(read_texts(args.input, args.column), done, None)
+    if done:
+        print("Resuming after {:,} messages".format(done), file=sys.stderr)
+
+    output = open(args.output, "a", newline="", encoding="utf-8")
+    writer = csv.writer(output) if args.format == "csv" else None
+    if writer and not done and not has_header:
+        writer.writerow(header)
+
+    def write(batch, scores):
+        for text, score in zip(batch, scores):
+            if writer:
+                writer.writerow([text, "{:.6f}".format(score), int(score >= args.threshold)])
+            else:
+                output.write(json.dumps({"text": text, "score": score, "toxic": score >= args.threshold}, ensure_ascii=False) + "\n")
+
+    def submit(batch):
+        if checker.pool:
+            return checker.pool.submit(normalize_batch(batch))
+        future = Future()
+        future.set_result(checker.score_batch(normalize_batch(batch)))
+        return future
+
+    # At most two batches per worker are in flight, so memory use does not depend on the input size
+    pending = deque()
+    scored = 0
+    start = last_report = time.monotonic()
+    for batch in batches(texts, args.batch_size):
+        pending.append((batch, submit(batch)))
+        while len(pending) > 2 * max(1, args.processes):
+            batch, future = pending.popleft()
+            write(batch, future.result())
+            scored += len(batch)
+        if time.monotonic() - last_report > args.report_interval:
+            last_report = time.monotonic()
+            output.flush()
+            print("{:,} messages, {:.1f} msg/s".format(scored, scored / (last_report - start)), file=sys.stderr)
+    while pending:
+        batch, future = pending.popleft()
+        write(batch, future.result())
+        scored += len(batch)
+    output.close()
+    print("Done: {:,} messages in {:.1f} s, {:.1f} msg/s".format(scored, time.monotonic() - start, scored / max(time.monotonic() - start, 1e-9)), file=sys.stderr)
+    if checker.pool:
+        checker.pool.stop()
+
+
+if __name__ == '__main__':
+    main()
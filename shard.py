@@ -0,0 +1,192 @@
+from typing import Callable, Iterable, Tuple
+import multiprocessing
+import threading
+import hashlib
+import logging
+import bisect
+import signal
+
+from telegram import Update
+from telegram.ext import CallbackContext, ConversationHandler, Dispatcher, Updater
+
+from pipeline import Pipeline
+from actions import ActionScheduler
+
+logger = logging.getLogger(__name__)
+
+
+def position(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+
+class HashRing():
+    """Consistent hashing of chat ids over worker names.
+
+    Adding or removing a worker only moves the chats of the neighbouring points.
+    """
+
+    def __init__(self, nodes: Iterable[str] = (), replicas: int = 100):
+        self.replicas = replicas
+        self.points = []
+        self.nodes = []
+        for node in nodes:
+            self.add(node)
+
+    def add(self, node: str):
+        self.nodes.append(node)
+        for i in range(self.replicas):
+            bisect.insort(self.points, (position("%s:%d" % (node, i)), node))
+
+    def remove(self, node: str):
+        self.nodes.remove(node)
+        self.points = [point for point in self.points if point[1] != node]
+
+    def get(self, key: int) -> str:
+        index = bisect.bisect(self.points, (position(str(key)), "")) % len(self.points)
+        return self.points[index][1]
+
+
+def shard_key(update: Update) -> int:
+    if update.effective_chat:
+        return update.effective_chat.id
+    if update.effective_user:
+        return update.effective_user.id
+    return 0
+
+
+def reload_conversations(dispatcher: Dispatcher, handlers=None):
+    # Conversation states of chats this worker just took over were written by another worker
+    if handlers is None:
+        handlers = [handler for group in dispatcher.handlers.values() for handler in group]
+    for handler in handlers:
+        if isinstance(handler, ConversationHandler):
+            if handler.persistent:
+                handler.conversations = dispatcher.persistence.get_conversations(handler.name)
+            nested = handler.entry_points + handler.fallbacks + [h for state in handler.states.values() for h in state]
+            reload_conversations(dispatcher, nested)
+
+
+def serve(name: str, build: Callable[..., Tuple[Updater, Pipeline, ActionScheduler]], metrics_port, inbox, outbox):
+    """Worker process: owns the chats the ring assigns to name and handles their updates in order."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    updater, pipeline, scheduler = build(metrics_port, background=False)
+    dispatcher = updater.dispatcher
+    persistence = dispatcher.persistence
+    # Updates are handled on this thread, the dispatcher thread only runs the run_async handlers
+    threading.Thread(target=dispatcher.start, name="Dispatcher", daemon=True).start()
+    ring = HashRing()
+    outbox.put(("ready", name))
+    while True:
+        message = inbox.get()
+        if message[0] == "update":
+            dispatcher.process_update(Update.de_json(message[1], updater.bot))
+        elif message[0] == "ring":
+            # Everything received so far is handled and stored before the other workers take over
+            pipeline.drain()
+            dispatcher.update_persistence()
+            persistence.write()
+            ring = HashRing(message[1])
+            for chat_id in list(dispatcher.chat_data):
+                if ring.get(chat_id) != name:
+                    del dispatcher.chat_data[chat_id]
+                    persistence.forget(chat_id)
+            reload_conversations(dispatcher)
+            outbox.put(("ack", name))
+        elif message[0] == "stop":
+            pipeline.drain()
+            pipeline.stop()
+            scheduler.stop()
+            dispatcher.stop()
+            dispatcher.update_persistence()
+            persistence.flush()
+            outbox.put(("stopped", name))
+            break
+
+
+class ShardRouter():
+    """Routes updates to worker processes by consistent hashing on chat_id.
+
+    Every worker has its own model and dispatcher and keeps the data of its chats.
+    Updates of one chat always go through one worker queue, so they are handled
+    in order. While workers are added or removed, routing pauses until every
+    worker has stored the data of chats it gives away.
+    """
+
+    def __init__(self, build: Callable[..., Tuple[Updater, Pipeline, ActionScheduler]], workers: int, metrics_port=None):
+        self.build = build
+        self.metrics_port = metrics_port
+        self.context = multiprocessing.get_context("spawn")
+        self.outbox = self.context.Queue()
+        self.inboxes = dict()
+        self.processes = dict()
+        self.count = 0
+        self.lock = threading.Lock()
+        # Held while workers are added or removed
+        self.changing = threading.Lock()
+        for _ in range(workers):
+            self.start_worker()
+        self.ring = HashRing(self.inboxes)
+        self.broadcast(("ring", self.ring.nodes), "ack")
+        signal.signal(signal.SIGUSR1, lambda signum, frame: threading.Thread(target=self.add_worker).start())
+        signal.signal(signal.SIGUSR2, lambda signum, frame: threading.Thread(target=self.remove_worker).start())
+
+    def start_worker(self) -> str:
+        name = "shard-%d" % self.count
+        port = self.metrics_port + 1 + self.count if self.metrics_port else None
+        self.count += 1
+        inbox = self.context.Queue()
+        process = self.context.Process(target=serve, args=(name, self.build, port, inbox, self.outbox), name=name)
+        process.start()
+        self.inboxes[name] = inbox
+        self.processes[name] = process
+        self.wait({name}, "ready")
+        logger.info("Started %s", name)
+        return name
+
+    def wait(self, names, kind: str):
+        names = set(names)
+        while names:
+            received, name = self.outbox.get()
+            if received == kind:
+                names.discard(name)
+
+    def broadcast(self, message, reply: str):
+        for inbox in self.inboxes.values():
+            inbox.put(message)
+        self.wait(self.inboxes, reply)
+
+    def route(self, update: Update, context: CallbackContext) -> None:
+        with self.lock:
+            self.inboxes[self.ring.get(shard_key(update))].put(("update", update.to_dict()))
+
+    def add_worker(self):
+        with self.changing:
+            # The new worker loads its model while updates keep flowing to the others
+            name = self.start_worker()
+            with self.lock:
+                ring = HashRing(self.ring.nodes + [name])
+                self.broadcast(("ring", ring.nodes), "ack")
+                self.ring = ring
+
+    def remove_worker(self):
+        with self.changing, self.lock:
+            if len(self.ring.nodes) == 1:
+                logger.warning("Not removing the last worker")
+                return
+            name = self.ring.nodes[-1]
+            ring = HashRing(self.ring.nodes[:-1])
+            self.broadcast(("ring", ring.nodes), "ack")
+            self.ring = ring
+            self.stop_worker(name)
+
+    def stop_worker(self, name: str):
+        self.inboxes[name].put(("stop",))
+        self.wait({name}, "stopped")
+        self.processes.pop(name).join()
+        del self.inboxes[name]
+        logger.info("Stopped %s", name)
+
+    def stop(self):
+        with self.changing, self.lock:
+            for name in list(self.inboxes):
+                self.stop_worker(name)
@@ -0,0 +1,73 @@
+from typing import Dict
+import sys
+import time
+
+
+class Strike():
+    __slots__ = ("expires", "rule")
+
+    def __init__(self, expires: float, rule: int):
+        self.expires = expires
+        self.rule = rule
+
+
+class Strikes():
+    """Index of the next rule to apply to each user of a chat.
+
+    A user goes back to the first rule once the reset time of their next rule
+    has passed, at which point their record is dropped.
+    """
+
+    sweep_interval = 60
+
+    def __init__(self):
+        self.records = dict()
+        self.last_sweep = 0.0
+
+    def current(self, user_id: int) -> int:
+        strike = self.records.get(user_id)
+        if strike is None:
+            return 0
+        if strike.expires <= time.time():
+            self.records.pop(user_id, None)
+            return 0
+        return strike.rule
+
+    def record(self, user_id: int, rule: int, reset_time: float):
+        now = time.time()
+        if rule == 0 or reset_time <= 0:
+            self.records.pop(user_id, None)
+        else:
+            self.records[user_id] = Strike(now + reset_time, rule)
+        if now - self.last_sweep > self.sweep_interval:
+            self.sweep(now)
+
+    def sweep(self, now: float):
+        self.last_sweep = now
+        for user_id, strike in list(self.records.items()):
+            if strike.expires <= now:
+                self.records.pop(user_id, None)
+
+    def __len__(self):
+        return len(self.records)
+
+    def stats(self) -> Dict[str, int]:
+        records = list(self.records.values())
+        return {
+            "users": len(records),
+            "bytes": sys.getsizeof(self.records) + sum(sys.getsizeof(strike) for strike in records),
+        }
+
+
+def total_stats(chat_data: Dict[int, dict]) -> Dict[str, int]:
+    """Sums Strikes.stats over the chats loaded in a dispatcher's chat_data."""
+    total = {"chats": 0, "users": 0, "bytes": 0}
+    # Copied first, the dispatcher adds chats while this runs on the metrics thread
+    for data in list(chat_data.values()):
+        strikes = data.get("strikes")
+        if strikes is None:
+            continue
+        total["chats"] += 1
+        for key, value in strikes.stats().items():
+            total[key] += value
+    return total
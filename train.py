@@ -1,14 +1,65 @@
+import contextlib
+import argparse
+import sys
+import os
 
-model_name = "cointegrated/rubert-tiny"
+parser = argparse.ArgumentParser(description="Fine-tune the toxicity classifier on train.csv and save it to ./model")
+parser.add_argument("--model-name", default="cointegrated/rubert-tiny", help="pretrained model to start from")
+parser.add_argument("--data", default="./train.csv")
+parser.add_argument("--max-length", type=int, default=128, help="messages with more tokens are left out")
+parser.add_argument("--batch-size", type=int, default=32)
+parser.add_argument("--accumulation-steps", type=int, default=1,
+                    help="batches whose gradients are summed per optimizer step, the effective batch size is batch-size x accumulation-steps")
+parser.add_argument("--epochs", type=int, default=3)
+parser.add_argument("--lr", type=float, default=2e-5)
+parser.add_argument("--seed", type=int, default=42)
+parser.add_argument("--cpu", action="store_true", help="train on the CPU even if a GPU is available")
+parser.add_argument("--bf16", action="store_true", help="run forward passes under bfloat16 autocast if the device supports it")
+parser.add_argument("--threads", type=int, default=None, help="intra-op threads, by default one per core")
+parser.add_argument("--interop-threads", type=int, default=None, help="inter-op threads")
+parser.add_argument("--workers", type=int, default=0, help="DataLoader worker processes")
+parser.add_argument("--chunk-size", type=int, default=100000, help="CSV rows read and encoded at a time when the dataset is built")
+parser.add_argument("--preprocess-workers", type=int, default=None, help="processes encoding the CSV when the dataset is built, by default one per core")
+parser.add_argument("--no-dynamic-padding", dest="dynamic_padding", action="store_false",
+                    help="pad every example to max-length in random batches instead of length-bucketed batches")
+parser.add_argument("--stats", default="training_stats.json", help="where statistics of this run are written")
+parser.add_argument("--baseline-stats", default=None,
+                    help="statistics of a previous run to compare epoch time, tokens per second and the final F-score against")
+parser.add_argument("--max-fscore-drop", type=float, default=0.01, help="largest drop of the final F-score against the baseline that is accepted")
+args = parser.parse_args()
+
+model_name = args.model_name
 
 import torch
+import torch.distributed as dist
 import random
 
+# Launched by torchrun with several processes, e.g. on one host:
+#   torchrun --standalone --nproc_per_node 4 train.py --cpu
+# or on several hosts with --nnodes and --rdzv_endpoint, every process trains on its own share
+# of each epoch and gradients are averaged over gloo after every backward pass.
+world_size = int(os.environ.get("WORLD_SIZE", 1))
+rank = int(os.environ.get("RANK", 0))
+local_rank = int(os.environ.get("LOCAL_RANK", 0))
+distributed = world_size > 1
+if distributed:
+    dist.init_process_group("gloo")
+    print('Process {} of {}'.format(rank + 1, world_size))
+
+# Thread pools have to be sized before torch runs anything in parallel.
+# Processes on the same host share its cores.
+if args.threads:
+    torch.set_num_threads(args.threads)
+elif distributed:
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // int(os.environ.get("LOCAL_WORLD_SIZE", 1))))
+if args.interop_threads:
+    torch.set_num_interop_threads(args.interop_threads)
+
 # If there's a GPU available...
-if torch.cuda.is_available():    
+if torch.cuda.is_available() and not args.cpu:
 
     # Tell PyTorch to use the GPU.    
-    device = torch.device("cuda")
+    device = torch.device("cuda", local_rank)
 
     print('There are %d GPU(s) available.' % torch.cuda.device_count())
 
@@ -16,21 +67,28 @@ if torch.cuda.is_available():
 
 # If not...
 else:
-    print('No GPU available, using the CPU instead.')
+    print('No GPU available, using the CPU instead.' if not args.cpu else 'Using the CPU.')
     device = torch.device("cpu")
+    print('{} intra-op and {} inter-op threads'.format(torch.get_num_threads(), torch.get_num_interop_threads()))
 
 
-import pandas as pd
-import re
+def bf16_supported(device) -> bool:
+    if device.type == "cuda":
+        return torch.cuda.is_bf16_supported()
+    # bfloat16 matmuls are only fast on CPUs with AVX512-BF16 or AMX, elsewhere they are emulated
+    try:
+        return torch.ops.mkldnn._is_mkldnn_bf16_supported()
+    except (AttributeError, RuntimeError):
+        return False
 
-# Load the dataset into a pandas dataframe.
-df = pd.read_csv("./train.csv")
+use_bf16 = args.bf16 and bf16_supported(device)
+if args.bf16 and not use_bf16:
+    print('bfloat16 is not supported on this device, training in float32.')
 
-# Report the number of sentences.
-print('Number of training sentences: {:,}\n'.format(df.shape[0]))
 
-df["label"] = df.apply(lambda row: '1' if row.toxic == 1 else 0, axis=1)
-df["sentence"] = df.apply(lambda row: row.comment.replace('\n', '.'), axis=1)
+import functools
+
+import dataset
 
 print("Parsing data...")
 
@@ -41,118 +99,98 @@ print('Loading BERT tokenizer...')
 tokenizer = AutoTokenizer.from_pretrained(model_name, do_lower_case=True)
 
 
-maxlen = 128
-
-
-
-def preprocess(sentence: str) -> str:
-    sentence = re.sub(re.compile(r"<[^>]*>"), " ", sentence)
-    sentence = re.sub(re.compile(r"^\[id\d*|.*\],*\s*"), "", sentence)
-    sentence = re.sub(re.compile(r"(&quot;)|(&lt;)|(&gt;)|(&amp;)|(&apos;)"), " ", sentence)
-    sentence = re.sub(re.compile(
-        r"https?://(www\.)?[-a-zA-Z0-9@:%._+~#=]{2,256}\.[a-z]{2,6}\b([-a-zA-Z0-9@:%_+.~#?&/=]*)")," ", sentence)
-    sentence = re.sub(re.compile(r"\[[^\[\]]+\|([^\[\]]+)\]"), r"\1", sentence)
-    sentence = re.sub(re.compile(r"(&#\d+;)"), " ", sentence)
-    sentence = re.sub(re.compile(r"[(_#*=^/`@«»©…“•—<>\[\]\"'+%|&]"), " ", sentence)
-    sentence = re.sub(re.compile(r"[.,!?\;:)(_#*=^/`@«»©…“•—<>\[\]\"'+%|&]"), " ", sentence)
-    sentence = sentence.replace("  ", " ")
-    sentence = sentence.replace("--", " ")
-    sentence = sentence.replace('\n', ' ')
-    sentence = re.sub("\s\s+", " ", sentence)
-    sentence = sentence.lower()
-    return sentence
-
-#print(len(df.sentence.values))
-df.sentence = df.apply(lambda row: preprocess(row.sentence), axis=1)
-
-#print(df.sentence.values[0])
+maxlen = args.max_length
 
-df = df[[len(tokenizer.encode(row.sentence)) <= maxlen for (i, row) in df.iterrows()]]
+# Messages are normalized and tokenized once into memory-mapped files under ./dataset,
+# they are built again only when train.csv, the tokenizer or the normalizer change.
+# The CSV is read and encoded in chunks by a process pool, see dataset.py.
+# Messages longer than maxlen tokens are left out.
+# With several processes the first one on every host builds it while the others wait.
+if local_rank == 0:
+    data = dataset.load(args.data, tokenizer, "./dataset", maxlen, args.chunk_size, args.preprocess_workers)
+if distributed:
+    dist.barrier()
+    if local_rank != 0:
+        data = dataset.load(args.data, tokenizer, "./dataset", maxlen, args.chunk_size, args.preprocess_workers)
 
-sentences = df.sentence.values
-labels = df.label.values
+# Report the number of sentences.
+print('Number of training sentences: {:,}\n'.format(len(data)))
 
-print("Parsing messages...")
+# Print sentence 0 as a list of IDs.
+print('Token IDs:', data[0][0])
 
-import torch
-# Tokenize all of the sentences and map the tokens to thier word IDs.
-input_ids = []
-attention_masks = []
-
-# For every sentence...
-for sent in sentences:
-    # `encode_plus` will:
-    #   (1) Tokenize the sentence.
-    #   (2) Prepend the `[CLS]` token to the start.
-    #   (3) Append the `[SEP]` token to the end.
-    #   (4) Map tokens to their IDs.
-    #   (5) Pad or truncate the sentence to `max_length`
-    #   (6) Create attention masks for [PAD] tokens.True` and
-    encoded_dict = tokenizer.encode_plus(
-                        sent,                      # Sentence to encode.
-                        add_special_tokens = True, # Add '[CLS]' and '[SEP]'
-                        max_length = 128,           # Pad & truncate all sentences.
-                        padding='max_length',
-                        return_attention_mask = True,   # Construct attn. masks.
-                        return_tensors = 'pt',     # Return pytorch tensors.
-                   )
-
-    # Add the encoded sentence to the list.
-    input_ids.append(encoded_dict['input_ids'])
-
-    # And its attention mask (simply differentiates padding from non-padding).
-    attention_masks.append(encoded_dict['attention_mask'])
-
-# Convert the lists into tensors.
-input_ids = torch.cat(input_ids, dim=0)
-attention_masks = torch.cat(attention_masks, dim=0)
-labels = torch.tensor([int(x) for x in labels])
-
-# Print sentence 0, now as a list of IDs.
-print('Original: ', sentences[0])
-print('Token IDs:', input_ids[0])
-
-from torch.utils.data import TensorDataset, random_split
-
-# Combine the training inputs into a TensorDataset.
-dataset = TensorDataset(input_ids, attention_masks, labels)
+from torch.utils.data import random_split
 
 # Create a 90-10 train-validation split.
 
 # Calculate the number of samples to include in each set.
-train_size = int(0.9999 * len(dataset))
-val_size = len(dataset) - train_size
+train_size = int(0.9999 * len(data))
+val_size = len(data) - train_size
 
 # Divide the dataset by randomly selecting samples.
-train_dataset, val_dataset = random_split(dataset, [train_size, val_size])
+# The split is seeded so that every process gets the same one.
+train_dataset, val_dataset = random_split(data, [train_size, val_size], generator=torch.Generator().manual_seed(args.seed))
 
-print(sum([int(row[2]) for row in val_dataset]))
+print(sum([row[1] for row in val_dataset]))
 
 
 print('{:>5,} training samples'.format(train_size))
 print('{:>5,} validation samples'.format(val_size))
 
 from torch.utils.data import DataLoader, RandomSampler, SequentialSampler
+from torch.utils.data.distributed import DistributedSampler
 
 # The DataLoader needs to know our batch size for training, so we specify it
 # here. For fine-tuning BERT on a specific task, the authors recommend a batch
 # size of 16 or 32.
-batch_size = 32
+batch_size = args.batch_size
 
-# Create the DataLoaders for our training and validation sets.
-# We'll take training samples in random order.
-train_dataloader = DataLoader(
-            train_dataset,  # The training samples.
-            sampler = RandomSampler(train_dataset), # Select batches randomly
-            batch_size = batch_size # Trains with this batch size.
-        )
+# With dynamic_padding, batches are made of examples of similar length and padded
+# only to the longest of them. Otherwise every example is padded to maxlen as before.
+dynamic_padding = args.dynamic_padding
+
+# Examples are read from the memory-mapped dataset and padded in worker processes
+loader_options = dict(num_workers=args.workers, persistent_workers=args.workers > 0, pin_memory=device.type == "cuda")
 
-# For validation the order doesn't matter, so we'll just read them sequentially.
-validation_dataloader = DataLoader(
-            val_dataset, # The validation samples.
-            sampler = SequentialSampler(val_dataset), # Pull out batches sequentially.
-            batch_size = batch_size # Evaluate with this batch size.
-        )
+# Create the DataLoaders for our training and validation sets.
+if dynamic_padding:
+    # Examples are shuffled, then grouped by length within pools of 100 batches.
+    train_dataloader = DataLoader(
+                train_dataset,  # The training samples.
+                batch_sampler = dataset.BucketBatchSampler(data.lengths[train_dataset.indices], batch_size, seed=args.seed,
+                                                           num_replicas=world_size, rank=rank),
+                collate_fn = functools.partial(dataset.collate, pad_token_id=tokenizer.pad_token_id), # Pads to the longest example.
+                **loader_options
+            )
+
+    # For validation the order doesn't matter, so examples are simply sorted by length.
+    validation_dataloader = DataLoader(
+                val_dataset, # The validation samples.
+                batch_sampler = dataset.BucketBatchSampler(data.lengths[val_dataset.indices], batch_size, shuffle=False,
+                                                           num_replicas=world_size, rank=rank),
+                collate_fn = functools.partial(dataset.collate, pad_token_id=tokenizer.pad_token_id),
+                **loader_options
+            )
+else:
+    # We'll take training samples in random order.
+    train_dataloader = DataLoader(
+                train_dataset,  # The training samples.
+                # Select batches randomly, every process from its own share
+                sampler = DistributedSampler(train_dataset, world_size, rank, seed=args.seed) if distributed else RandomSampler(train_dataset),
+                batch_size = batch_size, # Trains with this batch size.
+                collate_fn = functools.partial(dataset.collate, max_length=maxlen, pad_token_id=tokenizer.pad_token_id), # Pads examples to maxlen.
+                **loader_options
+            )
+
+    # For validation the order doesn't matter, so we'll just read them sequentially.
+    validation_dataloader = DataLoader(
+                val_dataset, # The validation samples.
+                # Pull out batches sequentially, every process takes every world_size-th example.
+                sampler = range(rank, len(val_dataset), world_size) if distributed else SequentialSampler(val_dataset),
+                batch_size = batch_size, # Evaluate with this batch size.
+                collate_fn = functools.partial(dataset.collate, max_length=maxlen, pad_token_id=tokenizer.pad_token_id),
+                **loader_options
+            )
 
 
 print("Loading model...")
@@ -171,10 +209,14 @@ model = BertForSequenceClassification.from_pretrained(
 
 model.to(device)
 
+# Every process holds a full copy of the model, DistributedDataParallel all-reduces the gradients
+if distributed:
+    model = torch.nn.parallel.DistributedDataParallel(model)
+
 # Note: AdamW is a class from the huggingface library (as opposed to pytorch)
 # I believe the 'W' stands for 'Weight Decay fix"
 optimizer = AdamW(model.parameters(),
-                  lr = 2e-5, # args.learning_rate - default is 5e-5, our notebook had 2e-5
+                  lr = args.lr, # args.learning_rate - default is 5e-5, our notebook had 2e-5
                   eps = 1e-8 # args.adam_epsilon  - default is 1e-8.
                 )
 
@@ -183,11 +225,14 @@ from transformers import get_linear_schedule_with_warmup
 # Number of training epochs. The BERT authors recommend between 2 and 4.
 # We chose to run for 4, but we'll see later that this may be over-fitting the
 # training data.
-epochs = 3
+epochs = args.epochs
+
+# Gradients of accumulation_steps batches are summed before each optimizer step.
+accumulation_steps = args.accumulation_steps
 
-# Total number of training steps is [number of batches] x [number of epochs].
+# Total number of training steps is [number of optimizer steps per epoch] x [number of epochs].
 # (Note that this is not the same as the number of training samples).
-total_steps = len(train_dataloader) * epochs
+total_steps = (len(train_dataloader) + accumulation_steps - 1) // accumulation_steps * epochs
 
 # Create the learning rate scheduler.
 scheduler = get_linear_schedule_with_warmup(optimizer,
@@ -244,7 +289,7 @@ import numpy as np
 # https://github.com/huggingface/transformers/blob/5bfcd0485ece086ebcbed2d008813037968a9e58/examples/run_glue.py#L128
 
 # Set the seed value all over the place to make this reproducible.
-seed_val = 42
+seed_val = args.seed
 
 random.seed(seed_val)
 np.random.seed(seed_val)
@@ -274,9 +319,20 @@ for epoch_i in range(0, epochs):
     # Measure how long the training epoch takes.
     t0 = time.time()
 
+    # Shuffle differently every epoch, the same way in every process
+    if distributed and not dynamic_padding:
+        train_dataloader.sampler.set_epoch(epoch_i)
+
     # Reset the total loss for this epoch.
     total_train_loss = 0
 
+    # Tokens of the messages and tokens fed to the model including padding.
+    total_tokens = 0
+    total_padded_tokens = 0
+
+    # Gradients are accumulated from here on and cleared after every optimizer step.
+    model.zero_grad()
+
     # Put the model into training mode. Don't be mislead--the call to 
     # `train` just changes the *mode*, it doesn't *perform* the training.
     # `dropout` and `batchnorm` layers behave differently during training
@@ -307,11 +363,8 @@ for epoch_i in range(0, epochs):
         b_input_mask = batch[1].to(device)
         b_labels = batch[2].to(device)
 
-        # Always clear any previously calculated gradients before performing a
-        # backward pass. PyTorch doesn't do this automatically because 
-        # accumulating the gradients is "convenient while training RNNs". 
-        # (source: https://stackoverflow.com/questions/48001598/why-do-we-need-to-call-zero-grad-in-pytorch)
-        model.zero_grad()        
+        total_tokens += int(batch[1].sum())
+        total_padded_tokens += batch[1].numel()
 
         # Perform a forward pass (evaluate the model on this training batch).
         # In PyTorch, calling `model` will in turn call the model's `forward` 
@@ -322,23 +375,34 @@ for epoch_i in range(0, epochs):
         # https://huggingface.co/transformers/main_classes/output.html#transformers.modeling_outputs.SequenceClassifierOutput
         # Specifically, we'll get the loss (because we provided labels) and the
         # "logits"--the model outputs prior to activation.
-        result = model(b_input_ids, 
-                       token_type_ids=None, 
-                       attention_mask=b_input_mask, 
-                       labels=b_labels,
-                       return_dict=True)
-
-        loss = result.loss
-        logits = result.logits
-
-        # Accumulate the training loss over all of the batches so that we can
-        # calculate the average loss at the end. `loss` is a Tensor containing a
-        # single value; the `.item()` function just returns the Python value 
-        # from the tensor.
-        total_train_loss += loss.item()
-
-        # Perform a backward pass to calculate the gradients.
-        loss.backward()
+        # With bf16 the matmuls run in bfloat16 while the weights and optimizer stay in float32.
+        # Gradients are only all-reduced on the batch before the optimizer step.
+        optimizer_step = (step + 1) % accumulation_steps == 0 or step + 1 == len(train_dataloader)
+        with contextlib.ExitStack() as stack:
+            if distributed and not optimizer_step:
+                stack.enter_context(model.no_sync())
+            with torch.autocast(device.type, dtype=torch.bfloat16, enabled=use_bf16):
+                result = model(b_input_ids, 
+                               token_type_ids=None, 
+                               attention_mask=b_input_mask, 
+                               labels=b_labels,
+                               return_dict=True)
+
+            loss = result.loss
+            logits = result.logits
+
+            # Accumulate the training loss over all of the batches so that we can
+            # calculate the average loss at the end. `loss` is a Tensor containing a
+            # single value; the `.item()` function just returns the Python value 
+            # from the tensor.
+            total_train_loss += loss.item()
+
+            # Perform a backward pass to calculate the gradients. They are summed
+            # over accumulation_steps batches, so the loss is scaled to their mean.
+            (loss / accumulation_steps).backward()
+
+        if not optimizer_step:
+            continue
 
         # Clip the norm of the gradients to 1.0.
         # This is to help prevent the "exploding gradients" problem.
@@ -352,15 +416,29 @@ for epoch_i in range(0, epochs):
         # Update the learning rate.
         scheduler.step()
 
+        # Always clear any previously calculated gradients before accumulating
+        # the next ones. PyTorch doesn't do this automatically because 
+        # accumulating the gradients is "convenient while training RNNs". 
+        # (source: https://stackoverflow.com/questions/48001598/why-do-we-need-to-call-zero-grad-in-pytorch)
+        model.zero_grad()
+
     # Calculate the average loss over all of the batches.
     avg_train_loss = total_train_loss / len(train_dataloader)            
     
     # Measure how long this epoch took.
-    training_time = format_time(time.time() - t0)
+    training_seconds = time.time() - t0
+
+    # Loss and token counts of all processes
+    if distributed:
+        totals = torch.tensor([avg_train_loss, total_tokens, total_padded_tokens], dtype=torch.float64)
+        dist.all_reduce(totals)
+        avg_train_loss, total_tokens, total_padded_tokens = totals[0].item() / world_size, totals[1].item(), totals[2].item()
+    training_time = format_time(training_seconds)
 
     print("")
     print("  Average training loss: {0:.2f}".format(avg_train_loss))
     print("  Training epcoh took: {:}".format(training_time))
+    print("  Tokens per second: {:,.0f}, padding: {:.0%}".format(total_tokens / training_seconds, 1 - total_tokens / total_padded_tokens))
         
     # ========================================
     #               Validation
@@ -377,6 +455,10 @@ for epoch_i in range(0, epochs):
     # during evaluation.
     model.eval()
 
+    # Processes may get a different number of validation batches, so they run
+    # the model without DistributedDataParallel, which would wait for each other.
+    eval_model = model.module if distributed else model
+
     # Tracking variables
     total_eval_loss = 0
     nb_eval_steps = 0
@@ -402,12 +484,12 @@ for epoch_i in range(0, epochs):
         
         # Tell pytorch not to bother with constructing the compute graph during
         # the forward pass, since this is only needed for backprop (training).
-        with torch.no_grad():        
+        with torch.no_grad(), torch.autocast(device.type, dtype=torch.bfloat16, enabled=use_bf16):
 
             # Forward pass, calculate logit predictions.
             # token_type_ids is the same as the "segment ids", which 
             # differentiates sentence 1 and 2 in 2-sentence tasks.
-            result = model(b_input_ids, 
+            result = eval_model(b_input_ids, 
                            token_type_ids=None, 
                            attention_mask=b_input_mask,
                            labels=b_labels,
@@ -423,7 +505,7 @@ for epoch_i in range(0, epochs):
         total_eval_loss += loss.item()
 
         # Move logits and labels to CPU
-        logits = logits.detach().cpu().numpy()
+        logits = logits.detach().float().cpu().numpy()
         label_ids = b_labels.to('cpu').numpy()
 
         # Calculate the accuracy for this batch of test sentences, and
@@ -432,15 +514,26 @@ for epoch_i in range(0, epochs):
         total_labels = np.concatenate((total_labels, label_ids))
         
 
+    # Predictions, labels and loss of all processes
+    total_eval_steps = len(validation_dataloader)
+    if distributed:
+        gathered = [None] * world_size
+        dist.all_gather_object(gathered, (total_logits, total_labels, total_eval_loss, total_eval_steps))
+        total_logits = np.concatenate([part[0] for part in gathered])
+        total_labels = np.concatenate([part[1] for part in gathered])
+        total_eval_loss = sum(part[2] for part in gathered)
+        total_eval_steps = sum(part[3] for part in gathered)
+
     # Report the final accuracy for this validation run.
     avg_val_accuracy = flat_accuracy(total_logits, total_labels)
     print("  Accuracy: {0:.2f}".format(avg_val_accuracy))
     print("  Precision: {0:.2f}".format(flat_precision(total_logits, total_labels)))
     print("  Recall: {0:.2f}".format(flat_recall(total_logits, total_labels)))
-    print("  F-score: {0:.2f}".format(flat_fscore(total_logits, total_labels)))
+    val_fscore = flat_fscore(total_logits, total_labels)
+    print("  F-score: {0:.2f}".format(val_fscore))
 
     # Calculate the average loss over all of the batches.
-    avg_val_loss = total_eval_loss / len(validation_dataloader)
+    avg_val_loss = total_eval_loss / total_eval_steps
     
     # Measure how long the validation run took.
     validation_time = format_time(time.time() - t0)
@@ -455,8 +548,12 @@ for epoch_i in range(0, epochs):
             'Training Loss': avg_train_loss,
             'Valid. Loss': avg_val_loss,
             'Valid. Accur.': avg_val_accuracy,
+            'Valid. F-score': val_fscore,
             'Training Time': training_time,
-            'Validation Time': validation_time
+            'Validation Time': validation_time,
+            'Training Seconds': training_seconds,
+            'Tokens per Second': total_tokens / training_seconds,
+            'Padding': 1 - total_tokens / total_padded_tokens
         }
     )
 
@@ -465,6 +562,31 @@ print("Training complete!")
 
 print("Total training took {:} (h:mm:ss)".format(format_time(time.time()-total_t0)))
 
-import os
-model.save_pretrained("./model")
+import json
+
+# Only the first process writes statistics and the model
+if rank != 0:
+    dist.destroy_process_group()
+    sys.exit()
+
+with open(args.stats, "w") as file:
+    json.dump({"options": vars(args), "bf16": use_bf16, "threads": torch.get_num_threads(), "processes": world_size, "epochs": training_stats}, file, indent=2)
+
+if args.baseline_stats:
+    with open(args.baseline_stats) as file:
+        baseline = json.load(file)["epochs"]
+    epoch_seconds = np.mean([stats['Training Seconds'] for stats in training_stats])
+    baseline_seconds = np.mean([stats['Training Seconds'] for stats in baseline])
+    tokens_per_second = np.mean([stats['Tokens per Second'] for stats in training_stats])
+    baseline_tokens_per_second = np.mean([stats['Tokens per Second'] for stats in baseline])
+    print("Epoch time: {:.0f} s, baseline {:.0f} s ({:.2f}x)".format(epoch_seconds, baseline_seconds, baseline_seconds / epoch_seconds))
+    print("Tokens per second: {:,.0f}, baseline {:,.0f} ({:.2f}x)".format(tokens_per_second, baseline_tokens_per_second, tokens_per_second / baseline_tokens_per_second))
+    fscore, baseline_fscore = training_stats[-1]['Valid. F-score'], baseline[-1]['Valid. F-score']
+    print("F-score: {:.4f}, baseline {:.4f}".format(fscore, baseline_fscore))
+    assert fscore >= baseline_fscore - args.max_fscore_drop, "F-score regressed by {:.4f}".format(baseline_fscore - fscore)
+
+model = model.module if distributed else model
+model.save_pretrained("./model", safe_serialization=True)
 os.system("tar -cvJf model.tar.xz ./model")
+if distributed:
+    dist.destroy_process_group()
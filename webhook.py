@@ -0,0 +1,65 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+import logging
+import json
+
+from telegram import Update
+from telegram.ext import Dispatcher
+
+logger = logging.getLogger(__name__)
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        server = self.server
+        if self.path != server.path:
+            self.send_error(404)
+            return
+        # Telegram redelivers the update later if the dispatcher is too far behind
+        if server.dispatcher.update_queue.qsize() >= server.max_pending:
+            self.send_error(503)
+            return
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+        try:
+            update = Update.de_json(json.loads(body), server.dispatcher.bot)
+        except Exception:
+            logger.exception("Failed to decode update")
+            return
+        server.dispatcher.update_queue.put(update)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class WebhookServer(ThreadingHTTPServer):
+    """Receives updates from Telegram and puts them into the dispatcher's update queue.
+
+    Up to workers requests are read and decoded at once, the rest wait for a free
+    worker. Requests are answered with 503 while max_pending updates are queued.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, dispatcher: Dispatcher, host: str, port: int, path: str, workers: int = 16, max_pending: int = 10000):
+        super().__init__((host, port), WebhookHandler)
+        self.dispatcher = dispatcher
+        self.path = path
+        self.max_pending = max_pending
+        self.workers = threading.BoundedSemaphore(workers)
+
+    def process_request(self, request, client_address):
+        self.workers.acquire()
+        super().process_request(request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            self.workers.release()
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name="Webhook", daemon=True).start()
+        logger.info("Listening for updates on http://%s:%d%s", self.server_address[0], self.server_address[1], self.path)
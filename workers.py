@@ -0,0 +1,135 @@
+from typing import Callable, List, Optional
+from concurrent.futures import Future
+import multiprocessing
+import itertools
+import threading
+import queue
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+
+def set_torch_threads(threads: int):
+    import torch
+    torch.set_num_threads(threads)
+
+
+def work(score_batch: Callable[[List[str]], List[float]], initialize: Callable[[int], None], tasks, results, assigned, threads: int, index: int):
+    initialize(threads)
+    score_batch(["прогрев модели"])
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        task_id, sentences = task
+        # Lets the parent fail this task if the worker dies before its result is sent.
+        # Shared memory is written right away, unlike the queue that is flushed by a thread.
+        assigned[index] = task_id
+        try:
+            results.put((task_id, score_batch(sentences), None))
+        except Exception as e:
+            results.put((task_id, None, repr(e)))
+
+
+class ProcessScorer():
+    """Runs score_batch in forked worker processes.
+
+    The model must already be loaded in the parent: workers are forked from it and
+    share the read-only weights through copy-on-write. Every worker first calls
+    initialize(threads), which by default limits torch to its share of the cores. Batches go to whichever
+    worker takes them from the task queue first. When a worker dies (killed for
+    memory, crashed) the batch it was scoring fails; once none is left every
+    pending batch fails.
+    """
+
+    # Seconds between checks that the workers are alive when no results arrive
+    check_interval = 1.0
+
+    def __init__(self, score_batch: Callable[[List[str]], List[float]], processes: int, threads: Optional[int] = None,
+                 initialize: Callable[[int], None] = set_torch_threads):
+        context = multiprocessing.get_context("fork")
+        threads = threads or max(1, (os.cpu_count() or 1) // processes)
+        self.tasks = context.Queue()
+        self.results = context.Queue()
+        self.pending = dict()
+        self.lock = threading.Lock()
+        self.ids = itertools.count()
+        self.stopping = False
+        # Last task taken by each worker
+        self.assigned = context.Array("q", [-1] * processes, lock=False)
+        self.workers = [
+            context.Process(target=work, args=(score_batch, initialize, self.tasks, self.results, self.assigned, threads, i), name="ScoringWorker-%d" % i, daemon=True)
+            for i in range(processes)
+        ]
+        for worker in self.workers:
+            worker.start()
+        logger.info("Started %d scoring workers with %d threads each", processes, threads)
+        self.collector = threading.Thread(target=self.collect, name="ProcessScorer", daemon=True)
+        self.collector.start()
+
+    def submit(self, sentences: List[str]) -> Future:
+        future = Future()
+        with self.lock:
+            if not self.workers:
+                future.set_exception(RuntimeError("No scoring workers left"))
+                return future
+            task_id = next(self.ids)
+            self.pending[task_id] = future
+        self.tasks.put((task_id, sentences))
+        return future
+
+    def score_batch(self, sentences: List[str]) -> List[float]:
+        return self.submit(sentences).result()
+
+    def collect(self):
+        while True:
+            try:
+                item = self.results.get(timeout=self.check_interval)
+            except queue.Empty:
+                item = ()
+            if item is None:
+                break
+            if item:
+                task_id, scores, error = item
+                with self.lock:
+                    future = self.pending.pop(task_id, None)
+                # None if it already failed because its worker died
+                if future is None:
+                    continue
+                if error is None:
+                    future.set_result(scores)
+                else:
+                    future.set_exception(RuntimeError(error))
+            if not self.stopping:
+                self.check_workers()
+
+    def check_workers(self):
+        dead = [worker for worker in self.workers if not worker.is_alive()]
+        if not dead:
+            return
+        failed = []
+        with self.lock:
+            for worker in dead:
+                index = int(worker.name.rsplit("-", 1)[1])
+                logger.error("Scoring worker %s exited with code %s", worker.name, worker.exitcode)
+                self.workers.remove(worker)
+                task_id = self.assigned[index]
+                if task_id in self.pending:
+                    failed.append(self.pending.pop(task_id))
+            # Nobody is left to take the queued batches
+            if not self.workers:
+                logger.error("No scoring workers left")
+                failed += self.pending.values()
+                self.pending.clear()
+        for future in failed:
+            future.set_exception(RuntimeError("Scoring worker died"))
+
+    def stop(self):
+        self.stopping = True
+        for _ in self.workers:
+            self.tasks.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.results.put(None)
+        self.collector.join()